@@ -1,12 +1,92 @@
-from flask import Flask, request, Response, jsonify, render_template
+import datetime
+import gzip
+import logging
+import queue
+import zlib
+from flask import Flask, request, Response, render_template
 from config import Config
-from database.models import init_database, get_recent_messages, get_dashboard_metrics, get_pending_actions
-from whatsapp.message_processor import process_message
+from applog import configure_logging, get_logging_stats
+from jsoncodec import dumps, loads
+from metrics import render_metrics
+from database.models import (
+    check_schema, get_recent_messages, get_message_page, decode_message_cursor,
+    get_dashboard_metrics, get_pending_actions, refresh_dashboard_metrics,
+    get_dashboard_metrics_version, get_messages_version, get_pending_actions_version,
+)
+from database.events import get_event_broker
+from database.export import EXPORTS, FORMATS, open_export, export_chunks
+from database.pool import get_pool_stats
+from database.log_writer import get_log_writer_stats
+from whatsapp.message_processor import process_message, schedule_messages
+from whatsapp.workers import get_webhook_pool, get_webhook_pool_stats
+from whatsapp.outbox import start_outbox_drainer
+
+configure_logging()
+logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 app.config.from_object(Config)
 
-init_database()
+check_schema()
+
+if Config.OUTBOX_ENABLED and Config.OUTBOX_DRAIN_IN_WEB:
+    start_outbox_drainer()
+
+get_event_broker().watch_metrics(refresh_dashboard_metrics, Config.STREAM_METRICS_INTERVAL)
+
+def json_response(obj, status=200):
+    """Like jsonify, but encoded with the fast codec when it's available"""
+    return Response(dumps(obj), status=status, mimetype='application/json')
+
+def version_etag(name, version):
+    """Weak ETag for `name` at `version`, varying with the query string.
+
+    Weak because the same body may go out gzipped or not. None when the
+    version is unknown (database unavailable), which disables caching.
+    """
+    if version is None:
+        return None
+    return f"{name}-{version}-{zlib.crc32(request.query_string):x}"
+
+def not_modified(etag):
+    """A 304 if the client already holds `etag`, else None.
+
+    Look the version up before loading the data it describes: if the
+    data changes in between, the client gets newer data under an older
+    tag and simply refetches next time, never the other way round.
+    """
+    if etag is None or not request.if_none_match.contains_weak(etag):
+        return None
+    response = Response(status=304)
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def tagged(response, etag):
+    if etag is not None:
+        response.set_etag(etag, weak=True)
+        # Browsers revalidate every time, so polling fetches become 304s
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+COMPRESSIBLE = {'application/json', 'text/html', 'text/plain'}
+
+@app.after_request
+def compress(response):
+    """gzip non-streamed text responses of at least GZIP_MIN_BYTES"""
+    if (response.status_code != 200 or response.is_streamed or response.direct_passthrough
+            or response.mimetype not in COMPRESSIBLE or 'Content-Encoding' in response.headers):
+        return response
+    # Whether or not this one is gzipped, the choice depended on the header
+    response.vary.add('Accept-Encoding')
+    if not request.accept_encodings.quality('gzip'):
+        return response
+    data = response.get_data()
+    if len(data) < Config.GZIP_MIN_BYTES:
+        return response
+    response.set_data(gzip.compress(data, compresslevel=Config.GZIP_LEVEL))
+    response.headers['Content-Encoding'] = 'gzip'
+    return response
 
 @app.route('/')
 def dashboard():
@@ -21,43 +101,154 @@ def dashboard():
 
 @app.route('/api/metrics')
 def api_metrics():
-    metrics = get_dashboard_metrics()
-    return jsonify(metrics)
+    etag = version_etag('metrics', get_dashboard_metrics_version())
+    return not_modified(etag) or tagged(json_response(get_dashboard_metrics()), etag)
+
+@app.route('/api/pool-stats')
+def api_pool_stats():
+    return json_response(get_pool_stats())
+
+@app.route('/api/log-writer-stats')
+def api_log_writer_stats():
+    return json_response(get_log_writer_stats())
+
+@app.route('/api/logging-stats')
+def api_logging_stats():
+    return json_response(get_logging_stats())
+
+@app.route('/api/worker-stats')
+def api_worker_stats():
+    return json_response(get_webhook_pool_stats())
+
+@app.route('/metrics')
+def prometheus_metrics():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/stream')
+def api_stream():
+    """Server-Sent Events for the dashboard: metrics deltas, new messages and pending actions"""
+    broker = get_event_broker()
+    subscription = broker.subscribe(Config.STREAM_MAX_CLIENTS)
+    if subscription is None:
+        # Each stream holds a worker thread; the page falls back to polling
+        return Response("Too many live dashboards", status=503, mimetype='text/plain')
+
+    def stream():
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                try:
+                    event, data = subscription.get(timeout=Config.STREAM_KEEPALIVE)
+                except queue.Empty:
+                    # Comment line; also how a closed connection gets noticed
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: {event}\ndata: {dumps(data).decode('utf-8')}\n\n"
+        finally:
+            broker.unsubscribe(subscription)
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def _query_bool(name):
+    value = request.args.get(name)
+    if value is None:
+        return None
+    if value.lower() in ("true", "1"):
+        return True
+    if value.lower() in ("false", "0"):
+        return False
+    raise ValueError(f"{name} must be true or false")
+
+def _query_time(name):
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        # fromisoformat doesn't take a trailing Z before Python 3.11
+        return datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        raise ValueError(f"{name} must be an ISO 8601 time") from None
+
+def _query_limit():
+    value = request.args.get('limit')
+    if value is None:
+        return Config.MESSAGES_PAGE_SIZE
+    try:
+        limit = int(value)
+    except ValueError:
+        raise ValueError("limit must be a whole number") from None
+    return max(1, min(limit, Config.MESSAGES_PAGE_MAX))
 
 @app.route('/api/messages')
 def api_messages():
-    limit = request.args.get('limit', 50, type=int)
-    messages = get_recent_messages(limit)
-    
-    formatted_messages = []
-    for msg in messages:
-        formatted_messages.append({
-            'id': msg[0],
-            'sender': msg[1],
-            'message': msg[2],
-            'response': msg[3],
-            'success': msg[4],
-            'error_message': msg[5],
-            'timestamp': msg[6].strftime('%Y-%m-%d %H:%M:%S') if msg[6] else None
-        })
-    
-    return jsonify(formatted_messages)
+    """Message history, newest first, a page at a time.
+
+    Query parameters: limit (at most MESSAGES_PAGE_MAX), cursor (the
+    previous page's next_cursor), sender, success (true/false), and
+    since/until as ISO 8601 times (until is exclusive).
+    """
+    # Reject bad parameters before spending a query on the version
+    try:
+        limit = _query_limit()
+        cursor = request.args.get('cursor')
+        page = dict(
+            cursor=decode_message_cursor(cursor) if cursor else None,
+            sender=request.args.get('sender') or None,
+            success=_query_bool('success'),
+            since=_query_time('since'),
+            until=_query_time('until'),
+        )
+    except ValueError as e:
+        return json_response({'error': str(e)}, 400)
+
+    etag = version_etag('messages', get_messages_version())
+    cached = not_modified(etag)
+    if cached:
+        return cached
+
+    messages, next_cursor = get_message_page(limit, **page)
+    # Rows arrive as dicts with formatted timestamps and are encoded as-is
+    return tagged(json_response({'messages': messages, 'next_cursor': next_cursor}), etag)
+
+@app.route('/api/export/<name>')
+def api_export(name):
+    """Download every row of a table as NDJSON (default) or CSV.
+
+    Query parameters: format (ndjson/csv) and since/until as ISO 8601
+    times (until is exclusive). The body is streamed as it is read.
+    """
+    if name not in EXPORTS:
+        return json_response({'error': 'Not found'}, 404)
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in FORMATS:
+        return json_response({'error': 'format must be ndjson or csv'}, 400)
+    try:
+        since = _query_time('since')
+        until = _query_time('until')
+    except ValueError as e:
+        return json_response({'error': str(e)}, 400)
+
+    try:
+        export = open_export(name, since, until)
+    except Exception as e:
+        logger.error("Error starting %s export: %s", name, e)
+        return json_response({'error': 'Database unavailable'}, 503)
+    if export is None:
+        return json_response({'error': 'Too many exports running'}, 503)
+
+    filename = f"{name}-{datetime.date.today().isoformat()}.{fmt}"
+    response = Response(export_chunks(export, fmt), mimetype=FORMATS[fmt],
+                        headers={'Content-Disposition': f'attachment; filename="{filename}"',
+                                 'X-Accel-Buffering': 'no'})
+    # Runs even if the client goes away before the first chunk
+    response.call_on_close(export.close)
+    return response
 
 @app.route('/api/pending-actions')
 def api_pending_actions():
-    actions = get_pending_actions()
-    
-    formatted_actions = []
-    for action in actions:
-        formatted_actions.append({
-            'id': action[0],
-            'action_type': action[1],
-            'sender': action[2],
-            'details': action[3],
-            'created_at': action[4].strftime('%Y-%m-%d %H:%M:%S') if action[4] else None
-        })
-    
-    return jsonify(formatted_actions)
+    etag = version_etag('pending-actions', get_pending_actions_version())
+    return not_modified(etag) or tagged(json_response(get_pending_actions(as_dicts=True)), etag)
 
 @app.route("/webhook", methods=["GET"])
 def verify():
@@ -69,21 +260,33 @@ def verify():
 
 @app.route("/webhook", methods=["POST"])
 def webhook():
-    data = request.json
+    try:
+        data = loads(request.get_data())
+    except ValueError:
+        data = None
+    if not isinstance(data, dict) or not isinstance(data.get("entry"), list):
+        return "Invalid payload", 400
+
+    if Config.WEBHOOK_ASYNC:
+        # Acknowledge right away; the worker pool does the actual processing
+        if schedule_messages(data, get_webhook_pool()):
+            return "OK", 200
+        return "Busy", 503
+
     try:
         process_message(data)
         return "OK", 200
     except Exception as e:
-        print("⚠️ Error processing message:", e)
+        logger.exception("Error processing message: %s", e)
         return "Error processing message", 500
 
 @app.errorhandler(404)
 def not_found(error):
-    return jsonify({'error': 'Not found'}), 404
+    return json_response({'error': 'Not found'}, 404)
 
 @app.errorhandler(500)
 def internal_error(error):
-    return jsonify({'error': 'Internal server error'}), 500
+    return json_response({'error': 'Internal server error'}, 500)
 
 if __name__ == "__main__":
     app.run_server(debug=True, host='0.0.0.0', port=8050)
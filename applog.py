@@ -0,0 +1,139 @@
+"""Application logging: levels, per-logger sampling and a non-blocking handler.
+
+Modules log through the standard library (logging.getLogger(__name__)).
+configure_logging() routes every record through a bounded queue to a
+background thread, which does the formatting and the write to stdout, so
+request threads only pay for an enqueue. Records below the configured
+level are dropped before any formatting happens, so keep to %-style
+arguments rather than f-strings in log calls.
+
+LOG_SAMPLE_RATES keeps only a fraction of a logger's sub-WARNING records,
+e.g. "whatsapp.handler=0.1,database=0.5" (a prefix covers child loggers).
+Warnings and errors are never sampled.
+"""
+import atexit
+import logging
+import queue
+import random
+import sys
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+from config import Config
+from jsoncodec import dumps
+
+# Attributes every LogRecord has; anything else came in through extra=
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with any extra= fields included"""
+
+    def format(self, record):
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return dumps(entry).decode("utf-8")
+
+
+class SamplingFilter(logging.Filter):
+    """Keep a fraction of each configured logger's records below WARNING"""
+
+    def __init__(self, rates):
+        super().__init__()
+        # Longest prefix first, so "whatsapp.handler" beats "whatsapp"
+        self.rates = sorted(rates.items(), key=lambda item: -len(item[0]))
+
+    def rate_for(self, name):
+        for prefix, rate in self.rates:
+            if name == prefix or name.startswith(prefix + "."):
+                return rate
+        return 1.0
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rate_for(record.name)
+        return rate >= 1.0 or random.random() < rate
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """Hands records to the listener thread without formatting or waiting.
+
+    When the queue is full the record is dropped and counted, rather than
+    stalling the request.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    def prepare(self, record):
+        # Formatting happens on the listener thread
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+
+def parse_sample_rates(spec):
+    """Parse "name=rate,name=rate" into a dict, skipping malformed entries"""
+    rates = {}
+    for item in (spec or "").split(","):
+        name, _, rate = item.partition("=")
+        try:
+            rates[name.strip()] = float(rate)
+        except ValueError:
+            continue
+    return rates
+
+
+_listener = None
+_handler = None
+_configure_lock = threading.Lock()
+
+
+def configure_logging():
+    """Install the queue-backed handler on the root logger (once per process)"""
+    global _listener, _handler
+    with _configure_lock:
+        if _listener is not None:
+            return _handler
+
+        output = logging.StreamHandler(sys.stdout)
+        if Config.LOG_FORMAT == "json":
+            output.setFormatter(JsonFormatter())
+        else:
+            output.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+
+        log_queue = queue.Queue(maxsize=Config.LOG_QUEUE_SIZE)
+        _handler = NonBlockingQueueHandler(log_queue)
+        _handler.addFilter(SamplingFilter(parse_sample_rates(Config.LOG_SAMPLE_RATES)))
+
+        root = logging.getLogger()
+        root.handlers = [_handler]
+        root.setLevel(Config.LOG_LEVEL)
+
+        _listener = QueueListener(log_queue, output)
+        _listener.start()
+        atexit.register(_listener.stop)
+        return _handler
+
+
+def get_logging_stats():
+    if _handler is None:
+        return {}
+    return {"queued": _handler.queue.qsize(), "dropped": _handler.dropped}
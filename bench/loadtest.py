@@ -0,0 +1,320 @@
+"""End-to-end load test: the app, a local Graph API stand-in and synthetic parents.
+
+    python bench/loadtest.py [--rps 50] [--duration 30] [--workers 1] [--threads 8]
+                             [--graph-latency-ms 80] [--graph-error-rate 0.01]
+
+Starts the app under gunicorn (or Flask's threaded server with
+--workers 0) against the database in the usual DB_* variables, with
+GRAPH_API_URL pointed at a fake Graph API running in this process. Any
+other setting, e.g. WEBHOOK_ASYNC=true or OUTBOUND_RATE, is passed through
+from the environment.
+
+Parent conversations (menu, balance, tag report, phone change) are
+replayed at the target rate. Each sender's next message waits for its
+previous webhook to return, as a real parent's would. The senders are
+made up, so balance and tag lookups end in "not found" replies, but they
+run the same queries.
+
+Reports webhook latency, outbound send latency (webhook received to reply
+arriving at the fake Graph API, including retries), DB round trips per
+message and throughput. Round trips come from the app's /api/pool-stats,
+so they are only reported when the app runs as a single process.
+"""
+import argparse
+import itertools
+import json
+import os
+import queue
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def text(body):
+    return {"type": "text", "text": {"body": body}}
+
+
+def button(button_id):
+    return {"type": "interactive", "interactive": {"type": "button_reply", "button_reply": {"id": button_id}}}
+
+
+# Every message gets exactly one reply
+CONVERSATIONS = [
+    ("menu", [text("hi")]),
+    ("balance", [text("1"), button("balance_own")]),
+    ("tag_report", [text("menu"), text("2")]),
+    ("phone_change", [text("5"), text("self"), text("254700000000, 12345678")]),
+]
+
+
+class FakeGraphHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        server = self.server
+        if server.latency:
+            time.sleep(random.uniform(0.5, 1.5) * server.latency)
+
+        if random.random() < server.error_rate:
+            status = 500
+            reply = {"error": {"message": "Service temporarily unavailable", "code": 2}}
+            server.record_error()
+        else:
+            status = 200
+            reply = {"messages": [{"id": "wamid.fake"}]}
+            server.record(json.loads(body).get("to"))
+
+        data = json.dumps(reply).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeGraph(ThreadingHTTPServer):
+    """Accepts /messages calls and records when each recipient got a reply"""
+
+    daemon_threads = True
+
+    def __init__(self, latency, error_rate):
+        super().__init__(("127.0.0.1", 0), FakeGraphHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.lock = threading.Lock()
+        self.received = defaultdict(list)
+        self.calls = 0
+        self.errors = 0
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def record(self, recipient):
+        with self.lock:
+            self.received[recipient].append(time.monotonic())
+            self.calls += 1
+
+    def record_error(self):
+        with self.lock:
+            self.calls += 1
+            self.errors += 1
+
+    def delivered(self):
+        with self.lock:
+            return sum(len(times) for times in self.received.values())
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_app(args, graph_url, port):
+    env = dict(
+        os.environ,
+        GRAPH_API_URL=graph_url,
+        WHATSAPP_ACCESS_TOKEN="bench",
+        WHATSAPP_PHONE_NUMBER_ID="bench",
+    )
+    if args.workers:
+        cmd = ["gunicorn", "-w", str(args.workers), "--threads", str(args.threads),
+               "-b", f"127.0.0.1:{port}", "app:app"]
+    else:
+        cmd = [sys.executable, "-c",
+               f"from app import app; app.run(host='127.0.0.1', port={port}, threaded=True)"]
+    log = open(args.app_log, "ab")
+    return subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+def wait_ready(proc, app_url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit(f"App exited with status {proc.returncode}; see --app-log")
+        try:
+            if requests.get(f"{app_url}/api/pool-stats", timeout=1).ok:
+                return
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(0.2)
+    raise SystemExit("App did not start in time")
+
+
+def query_count(app_url):
+    try:
+        return requests.get(f"{app_url}/api/pool-stats", timeout=5).json().get("queries")
+    except (requests.exceptions.RequestException, ValueError):
+        return None
+
+
+class LoadGenerator:
+    """Sends conversation messages as webhooks at a target rate"""
+
+    def __init__(self, app_url, concurrency):
+        self.webhook_url = f"{app_url}/webhook"
+        self.concurrency = concurrency
+        self.ready = queue.Queue()
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.ids = itertools.count()
+        self.run_id = f"{os.getpid()}.{int(time.time())}"
+        self.latencies = []
+        self.failures = 0
+        self.sent_at = defaultdict(list)
+        self.flows = defaultdict(int)
+
+    def new_conversation(self):
+        n = next(self.ids)
+        name, messages = random.choice(CONVERSATIONS)
+        with self.lock:
+            self.flows[name] += 1
+        return f"2549{n:08d}", list(messages)
+
+    def session(self):
+        if not hasattr(self.local, "session"):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def send_next(self, conversation):
+        sender, messages = conversation
+        message = dict(messages.pop(0), id=f"wamid.bench.{self.run_id}.{next(self.ids)}")
+        message["from"] = sender
+        body = json.dumps({"entry": [{"changes": [{"value": {"messages": [message]}}]}]})
+
+        start = time.monotonic()
+        try:
+            response = self.session().post(
+                self.webhook_url, data=body,
+                headers={"Content-Type": "application/json"}, timeout=30
+            )
+            ok = response.status_code == 200
+        except requests.exceptions.RequestException:
+            ok = False
+        elapsed = time.monotonic() - start
+
+        with self.lock:
+            self.latencies.append(elapsed)
+            if ok:
+                self.sent_at[sender].append(start)
+            else:
+                self.failures += 1
+        self.ready.put(conversation if ok and messages else self.new_conversation())
+
+    def run(self, rps, duration):
+        for _ in range(self.concurrency):
+            self.ready.put(self.new_conversation())
+
+        interval = 1 / rps
+        start = time.monotonic()
+        end = start + duration
+        next_at = start
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            while True:
+                now = time.monotonic()
+                if now >= end:
+                    break
+                try:
+                    conversation = self.ready.get(timeout=end - now)
+                except queue.Empty:
+                    break
+                delay = next_at - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                # Fall behind by at most a second rather than bursting to catch up
+                next_at = max(next_at + interval, time.monotonic() - 1)
+                executor.submit(self.send_next, conversation)
+        return time.monotonic() - start
+
+
+def percentiles(values):
+    if not values:
+        return "n/a"
+    values = sorted(values)
+    pick = lambda p: values[min(len(values) - 1, int(p / 100 * len(values)))] * 1000
+    return f"p50 {pick(50):7.1f}ms  p95 {pick(95):7.1f}ms  p99 {pick(99):7.1f}ms"
+
+
+def send_latencies(sent_at, received):
+    """Pair each sender's n-th accepted webhook with its n-th delivered reply"""
+    latencies = []
+    for sender, starts in sent_at.items():
+        for start, arrived in zip(starts, received.get(sender, [])):
+            latencies.append(arrived - start)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rps", type=float, default=50)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--concurrency", type=int, default=100,
+                        help="conversations in flight at once")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="gunicorn workers; 0 runs Flask's threaded server")
+    parser.add_argument("--threads", type=int, default=8, help="gunicorn threads per worker")
+    parser.add_argument("--graph-latency-ms", type=float, default=80)
+    parser.add_argument("--graph-error-rate", type=float, default=0.01)
+    parser.add_argument("--drain-timeout", type=float, default=15,
+                        help="seconds to wait for replies still in flight")
+    parser.add_argument("--app-log", default=os.devnull)
+    args = parser.parse_args()
+
+    graph = FakeGraph(args.graph_latency_ms / 1000, args.graph_error_rate)
+    threading.Thread(target=graph.serve_forever, daemon=True).start()
+
+    port = free_port()
+    app_url = f"http://127.0.0.1:{port}"
+    proc = start_app(args, graph.url, port)
+    try:
+        wait_ready(proc, app_url)
+        queries_before = query_count(app_url)
+
+        load = LoadGenerator(app_url, args.concurrency)
+        elapsed = load.run(args.rps, args.duration)
+
+        accepted = sum(len(starts) for starts in load.sent_at.values())
+        deadline = time.monotonic() + args.drain_timeout
+        while graph.delivered() < accepted and time.monotonic() < deadline:
+            time.sleep(0.1)
+
+        queries_after = query_count(app_url)
+    finally:
+        proc.terminate()
+        proc.wait(10)
+        graph.shutdown()
+
+    sent = len(load.latencies)
+    delivered = graph.delivered()
+    print(f"Target {args.rps:g} msg/s for {args.duration:g}s; "
+          f"{'gunicorn ' + str(args.workers) + 'x' + str(args.threads) if args.workers else 'flask threaded'}")
+    print(f"  conversations:     {dict(load.flows)}")
+    print(f"  webhooks sent:     {sent} ({load.failures} failed)")
+    print(f"  throughput:        {sent / elapsed:.1f} msg/s")
+    print(f"  webhook latency:   {percentiles(load.latencies)}")
+    print(f"  send latency:      {percentiles(send_latencies(load.sent_at, graph.received))}")
+    print(f"  replies delivered: {delivered}/{accepted} "
+          f"(Graph calls {graph.calls}, injected errors {graph.errors})")
+    if args.workers <= 1 and queries_before is not None and queries_after is not None and accepted:
+        print(f"  DB round trips:    {(queries_after - queries_before) / accepted:.2f} per message")
+    else:
+        print("  DB round trips:    n/a (needs a single app process)")
+
+
+if __name__ == "__main__":
+    main()
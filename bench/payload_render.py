@@ -0,0 +1,76 @@
+"""Per-send CPU for static replies, dict + JSON encoding vs pre-rendered bytes.
+
+    python bench/payload_render.py [--number 100000]
+
+"encode" is just the payload body: build_payload() plus the json.dumps
+requests does for json=, against PayloadTemplate.render(). "prepare"
+also runs requests' request preparation, the rest of the CPU work a send
+does before it touches the network.
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from whatsapp.handler import MAIN_MENU, BALANCE_OPTIONS, TAG_OPTIONS, build_payload
+from whatsapp.message_processor import TOPUP_INSTRUCTIONS, SUPPORT_REPLY
+
+URL = "https://graph.facebook.com/v19.0/123456789/messages"
+HEADERS = {"Authorization": "Bearer token", "Content-Type": "application/json"}
+SENDER = "254712345678"
+
+REPLIES = [
+    ("main menu", MAIN_MENU),
+    ("balance options", BALANCE_OPTIONS),
+    ("tag options", TAG_OPTIONS),
+    ("top-up", TOPUP_INSTRUCTIONS),
+    ("support", SUPPORT_REPLY),
+]
+
+
+def encode_dict(reply):
+    payload = build_payload(SENDER, reply.text, reply.buttons, reply.sections)
+    # What requests does with json=
+    return json.dumps(payload, allow_nan=False).encode("utf-8")
+
+
+def encode_template(reply):
+    return reply.template.render(SENDER)
+
+
+def prepare_dict(reply):
+    payload = build_payload(SENDER, reply.text, reply.buttons, reply.sections)
+    return requests.Request("POST", URL, headers=HEADERS, json=payload).prepare()
+
+
+def prepare_template(reply):
+    return requests.Request("POST", URL, headers=HEADERS, data=reply.template.render(SENDER)).prepare()
+
+
+def per_call(fn, reply, number):
+    return timeit.timeit(lambda: fn(reply), number=number) / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=100000)
+    args = parser.parse_args()
+
+    print(f"{'reply':16} {'encode: dict':>13} {'bytes':>8} {'prepare: dict':>14} {'bytes':>8}")
+    for name, reply in REPLIES:
+        print(
+            f"{name:16}"
+            f" {per_call(encode_dict, reply, args.number):11.2f}µs"
+            f" {per_call(encode_template, reply, args.number):6.2f}µs"
+            f" {per_call(prepare_dict, reply, args.number // 10):12.2f}µs"
+            f" {per_call(prepare_template, reply, args.number // 10):6.2f}µs"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Memory per concurrent tag-report session, old string-keyed dict vs Session.
+
+    python bench/session_memory.py [--sessions 100000]
+
+Every session is mid tag-report flow with two children and one selected,
+which is the largest state a parent can hold.
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from whatsapp.session import ChildTag, ConversationState, Session
+
+
+def child_rows(n):
+    # Fresh string objects for every row, like rows decoded from the database
+    return [
+        (n * 10 + i, f"Child {n}-{i}", "F".lower().upper(), f"Hill School {n % 5}",
+         f"Grade {n % 8}", n * 10 + i, "ACTIVE".lower())
+        for i in range(2)
+    ]
+
+
+def build_old(count):
+    user_states = {}
+    for n in range(count):
+        sender = f"2547{n:08d}"
+        rows = child_rows(n)
+        user_states[sender] = "awaiting_tag_action"
+        user_states[f"{sender}_children"] = rows
+        user_states[f"{sender}_selected_child"] = rows[0]
+    return user_states
+
+
+def build_new(count):
+    sessions = {}
+    for n in range(count):
+        sender = f"2547{n:08d}"
+        children = tuple(ChildTag.from_row(row) for row in child_rows(n))
+        sessions[sender] = Session(
+            state=ConversationState.AWAITING_TAG_ACTION,
+            children=children,
+            selected_child=children[0],
+        )
+    return sessions
+
+
+def measure(build, count):
+    tracemalloc.start()
+    store = build(count)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return store, size
+
+
+def reset_old(user_states, sender):
+    if sender in user_states:
+        del user_states[sender]
+    for key in list(user_states.keys()):
+        if key.startswith(f"{sender}_"):
+            del user_states[key]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=100000)
+    parser.add_argument("--resets", type=int, default=20)
+    args = parser.parse_args()
+
+    old, old_bytes = measure(build_old, args.sessions)
+    new, new_bytes = measure(build_new, args.sessions)
+
+    print(f"{args.sessions} concurrent sessions")
+    print(f"  string-keyed dict: {old_bytes / 2**20:8.1f} MiB  ({old_bytes / args.sessions:6.0f} B/session)")
+    print(f"  Session objects:   {new_bytes / 2**20:8.1f} MiB  ({new_bytes / args.sessions:6.0f} B/session)")
+
+    senders = [f"2547{n:08d}" for n in range(args.resets)]
+    start = time.perf_counter()
+    for sender in senders:
+        reset_old(old, sender)
+    old_reset = (time.perf_counter() - start) / args.resets
+
+    start = time.perf_counter()
+    for sender in senders:
+        new.pop(sender, None)
+    new_reset = (time.perf_counter() - start) / args.resets
+
+    print(f"  reset, prefix scan: {old_reset * 1e6:10.1f} µs")
+    print(f"  reset, single key:  {new_reset * 1e6:10.1f} µs")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""Routing cost per conversation state, old if/elif chain vs the state table.
+
+    python bench/state_dispatch.py [--number 200000]
+
+Only the routing decision is timed: handlers are not run, so no database
+or Graph API calls are made. `legacy_route` reproduces the order of checks
+the old generate_reply made, including building the menu dict of lambdas
+on every call.
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from whatsapp.message_processor import conversation
+from whatsapp.session import ConversationState
+
+# One representative input per state
+CASES = [
+    (None, "4"),
+    (None, "zzz"),
+    (ConversationState.AWAITING_BALANCE_PHONE, "254712345678"),
+    (ConversationState.AWAITING_BALANCE_ID, "12345678"),
+    (ConversationState.AWAITING_PHONE_CHANGE_TYPE, "self"),
+    (ConversationState.AWAITING_PHONE_VERIFICATION, "254712345678, 12345678"),
+    (ConversationState.AWAITING_NEW_NUMBER, "254798765432"),
+    (ConversationState.AWAITING_CHILD_SELECTION, "2"),
+    (ConversationState.AWAITING_TAG_ACTION, "back"),
+]
+
+
+def legacy_route(state, text_lower, sender="254700000001"):
+    if text_lower in ["menu", "start", "hi", "hello", "help"]:
+        return "restart"
+    if state in (ConversationState.AWAITING_BALANCE_PHONE, ConversationState.AWAITING_BALANCE_ID):
+        return "check_balance"
+    if state == ConversationState.AWAITING_PHONE_CHANGE_TYPE:
+        if text_lower == "self":
+            return "self"
+        elif text_lower == "other":
+            return "other"
+        return "unknown"
+    if state == ConversationState.AWAITING_PHONE_VERIFICATION:
+        return "verify"
+    elif state == ConversationState.AWAITING_NEW_NUMBER:
+        return "new_number"
+    elif state == ConversationState.AWAITING_TAG_ACTION:
+        if text_lower == "1":
+            return "replace"
+        elif text_lower == "2":
+            return "wait"
+        elif text_lower == "back":
+            return "back"
+        return "unknown"
+    elif state == ConversationState.AWAITING_CHILD_SELECTION:
+        if text_lower == "back":
+            return "back"
+        return "select"
+    menu_handlers = {
+        "1": lambda: sender,
+        "2": lambda: sender,
+        "3": lambda: sender,
+        "4": lambda: sender,
+        "5": lambda: sender,
+        "6": lambda: sender,
+    }
+    if text_lower in menu_handlers:
+        return menu_handlers[text_lower]
+    elif text_lower in ["1.1", "1.2"]:
+        return "check_balance"
+    return "unknown"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=200000)
+    args = parser.parse_args()
+
+    print(f"{'state':32} {'input':>24} {'if/elif':>10} {'table':>10}")
+    for state, text in CASES:
+        old = timeit.timeit(lambda: legacy_route(state, text), number=args.number)
+        new = timeit.timeit(lambda: conversation.resolve(state, text), number=args.number)
+        name = state.value if state else "(main menu)"
+        print(f"{name:32} {text:>24} {old / args.number * 1e9:8.0f}ns {new / args.number * 1e9:8.0f}ns")
+
+
+if __name__ == "__main__":
+    main()
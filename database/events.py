@@ -0,0 +1,212 @@
+import datetime
+import logging
+import queue
+import threading
+import time
+import psycopg
+from config import Config, DATABASE_CONFIG
+from jsoncodec import dumps, loads
+from .pool import after_commit
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "dashboard_events"
+
+# pg_notify payloads must stay under 8000 bytes
+NOTIFY_MAX_BYTES = 7000
+
+# The dashboard shows the first 80 characters; a little slack, not whole messages
+PREVIEW_CHARS = 120
+
+
+class EventBroker:
+    """Fans dashboard events out to the /api/stream connections in this process.
+
+    Each subscriber gets a bounded queue. A subscriber that falls behind
+    has its backlog replaced by a single "resync" event, telling the page
+    to reload its data, so a stalled tab can't hold memory or slow the
+    publishers down.
+
+    With watch_metrics() set up, message and pending-action events mark
+    the metrics as changed; a background thread then recomputes them at
+    most once per interval and publishes only the fields that changed.
+    """
+
+    def __init__(self, queue_size=500):
+        self.queue_size = queue_size
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._metrics_loader = None
+        self._metrics_interval = 1.0
+        self._metrics = {}
+        self._metrics_changed = threading.Event()
+        self._metrics_thread = None
+
+    def subscribe(self, max_subscribers=None):
+        """Return a queue of (event, data) pairs, or None if at capacity"""
+        subscription = queue.Queue(self.queue_size)
+        with self._lock:
+            if max_subscribers is not None and len(self._subscribers) >= max_subscribers:
+                return None
+            self._subscribers.add(subscription)
+            metrics = dict(self._metrics)
+        if self._metrics_loader is not None:
+            self._start_metrics_thread()
+            if metrics:
+                # New pages merge deltas onto the latest full snapshot
+                subscription.put_nowait(("metrics", metrics))
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def has_subscribers(self):
+        return bool(self._subscribers)
+
+    def publish(self, event, data):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscription in subscribers:
+            try:
+                subscription.put_nowait((event, data))
+            except queue.Full:
+                self._resync(subscription)
+        if event != "metrics":
+            self._metrics_changed.set()
+
+    def _resync(self, subscription):
+        while True:
+            try:
+                subscription.get_nowait()
+            except queue.Empty:
+                break
+        try:
+            subscription.put_nowait(("resync", None))
+        except queue.Full:
+            pass
+
+    def watch_metrics(self, loader, interval):
+        """Publish metric deltas from `loader()` when events say they changed"""
+        self._metrics_loader = loader
+        self._metrics_interval = interval
+
+    def _start_metrics_thread(self):
+        with self._lock:
+            if self._metrics_thread is not None:
+                return
+            self._metrics_thread = threading.Thread(target=self._run_metrics, name="dashboard-metrics", daemon=True)
+        self._metrics_changed.set()
+        self._metrics_thread.start()
+
+    def _run_metrics(self):
+        while True:
+            self._metrics_changed.wait()
+            # Coalesce a burst of events into one reload
+            time.sleep(self._metrics_interval)
+            self._metrics_changed.clear()
+            if not self.has_subscribers():
+                continue
+            try:
+                metrics = self._metrics_loader()
+            except Exception as e:
+                logger.error("Error loading dashboard metrics: %s", e)
+                continue
+            with self._lock:
+                delta = {key: value for key, value in metrics.items() if self._metrics.get(key) != value}
+                self._metrics = dict(metrics)
+            if delta:
+                self.publish("metrics", delta)
+
+
+def _listen_connection():
+    """A direct (session mode) connection; LISTEN doesn't survive pgbouncer's transaction mode"""
+    if Config.DASHBOARD_EVENTS_DSN:
+        return psycopg.connect(Config.DASHBOARD_EVENTS_DSN, autocommit=True)
+    return psycopg.connect(**DATABASE_CONFIG, autocommit=True)
+
+
+def _listen(broker):
+    """Relay NOTIFYs from every node to this process's subscribers"""
+    while True:
+        try:
+            with _listen_connection() as conn:
+                conn.execute(f"LISTEN {CHANNEL}")
+                for notify in conn.notifies():
+                    message = loads(notify.payload)
+                    broker.publish(message["event"], message["data"])
+        except Exception as e:
+            logger.warning("Dashboard event listener disconnected: %s", e)
+            time.sleep(5)
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_event_broker():
+    """Return the process-wide broker, listening for NOTIFYs if configured"""
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                _broker = EventBroker(Config.STREAM_QUEUE_SIZE)
+                if Config.DASHBOARD_EVENTS == "postgres":
+                    if not Config.DASHBOARD_EVENTS_DSN:
+                        logger.warning("DASHBOARD_EVENTS_DSN is not set; listening on the pooled "
+                                       "database address, which receives nothing through pgbouncer")
+                    threading.Thread(target=_listen, args=(_broker,), name="dashboard-listen", daemon=True).start()
+    return _broker
+
+
+def wants_events():
+    """Whether announce() would reach anyone, so callers can skip building events"""
+    return Config.DASHBOARD_EVENTS == "postgres" or (_broker is not None and _broker.has_subscribers())
+
+
+def _notify_payloads(event, data):
+    """Encode an event as pg_notify payloads, splitting lists to fit the size limit"""
+    if not isinstance(data, list):
+        yield dumps({"event": event, "data": data}).decode("utf-8")
+        return
+    chunk, size = [], 0
+    for item in data:
+        item_size = len(dumps(item)) + 1
+        if chunk and size + item_size > NOTIFY_MAX_BYTES:
+            yield dumps({"event": event, "data": chunk}).decode("utf-8")
+            chunk, size = [], 0
+        chunk.append(item)
+        size += item_size
+    if chunk:
+        yield dumps({"event": event, "data": chunk}).decode("utf-8")
+
+
+def announce(cursor, event, data):
+    """Tell live dashboards about a change made in `cursor`'s transaction.
+
+    With DASHBOARD_EVENTS=postgres this is a NOTIFY, which Postgres
+    delivers to every node once the transaction commits. Otherwise the
+    event goes to this process's subscribers, also only after the commit,
+    so a rolled-back change is never shown.
+    """
+    if Config.DASHBOARD_EVENTS == "postgres":
+        for payload in _notify_payloads(event, data):
+            cursor.execute("SELECT pg_notify(%s, %s)", (CHANNEL, payload))
+    elif _broker is not None:
+        after_commit(_broker.publish, event, data)
+
+
+def message_events(rows):
+    """Dashboard rows for freshly written message_logs rows"""
+    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    return [
+        {
+            "sender": sender,
+            "message": message[:PREVIEW_CHARS] if message else message,
+            "response": response[:PREVIEW_CHARS] if response else response,
+            "success": success,
+            "error_message": error_message[:PREVIEW_CHARS] if error_message else error_message,
+            "timestamp": timestamp,
+        }
+        for sender, message, response, success, error_message, processing_time in rows
+    ]
@@ -0,0 +1,148 @@
+"""Streaming exports of message_logs and pending_actions as NDJSON or CSV.
+
+Rows are read through a server-side (named) cursor, EXPORT_BATCH_SIZE at
+a time, and encoded as they arrive, so memory stays flat however many
+rows an export covers. Each export holds its own connection for as long
+as the download runs, outside the pool the message path uses, and at
+most EXPORT_MAX_CONCURRENT run at once per process.
+"""
+import csv
+import io
+import logging
+import threading
+import psycopg
+from config import Config, DATABASE_CONFIG
+from jsoncodec import dumps
+
+logger = logging.getLogger(__name__)
+
+# name: (columns, table, time column)
+EXPORTS = {
+    "messages": (
+        ("id", "sender", "message", "response", "success", "error_message", "processing_time_ms", "timestamp"),
+        "message_logs", "timestamp",
+    ),
+    "pending-actions": (
+        ("id", "action_type", "sender", "details", "status", "admin_notes", "created_at", "processed_at"),
+        "pending_actions", "created_at",
+    ),
+}
+
+FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+# Rows encoded per chunk handed to the web server
+ROWS_PER_CHUNK = 500
+
+_slots = threading.BoundedSemaphore(Config.EXPORT_MAX_CONCURRENT)
+
+
+class Export:
+    """One running export: a dedicated connection and its named cursor"""
+
+    def __init__(self, name, since=None, until=None):
+        self.columns, self.table, self.time_column = EXPORTS[name]
+        self.since = since
+        self.until = until
+        self.conn = None
+        self.cursor = None
+        self._closed = False
+
+    def open(self):
+        conditions, params = [], []
+        if self.since is not None:
+            conditions.append(f"{self.time_column} >= %s")
+            params.append(self.since)
+        if self.until is not None:
+            conditions.append(f"{self.time_column} < %s")
+            params.append(self.until)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+        # pgbouncer in transaction mode is fine here: the cursor lives in one transaction
+        self.conn = psycopg.connect(**DATABASE_CONFIG, prepare_threshold=None)
+        self.conn.read_only = True
+        self.cursor = self.conn.cursor(name=f"export_{self.table}")
+        self.cursor.itersize = Config.EXPORT_BATCH_SIZE
+        self.cursor.execute(f"""
+            SELECT {', '.join(self.columns)}
+            FROM {self.table}
+            {where}
+            ORDER BY {self.time_column}, id
+        """, params)
+
+    def rows(self):
+        yield from self.cursor
+
+    def close(self):
+        """Release the connection and the export slot (safe to call twice)"""
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            if self.conn is not None:
+                self.conn.close()
+        finally:
+            _slots.release()
+
+
+def open_export(name, since=None, until=None):
+    """Start an export, or return None if EXPORT_MAX_CONCURRENT are running.
+
+    The caller must close() the export once the response is finished.
+    Connection and query errors are raised here, before any output.
+    """
+    if not _slots.acquire(blocking=False):
+        return None
+    export = Export(name, since, until)
+    try:
+        export.open()
+    except Exception:
+        export.close()
+        raise
+    return export
+
+
+def ndjson_chunks(columns, rows):
+    """One JSON object per line"""
+    chunk = []
+    for row in rows:
+        chunk.append(dumps(dict(zip(columns, row))))
+        if len(chunk) >= ROWS_PER_CHUNK:
+            yield b"\n".join(chunk) + b"\n"
+            chunk = []
+    if chunk:
+        yield b"\n".join(chunk) + b"\n"
+
+
+def _csv_value(value):
+    if isinstance(value, (dict, list)):
+        return dumps(value).decode("utf-8")
+    return value
+
+
+def csv_chunks(columns, rows):
+    """A header line, then one line per row; JSON columns stay JSON"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    count = 0
+    for row in rows:
+        writer.writerow([_csv_value(value) for value in row])
+        count += 1
+        if count % ROWS_PER_CHUNK == 0:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode("utf-8")
+
+
+def export_chunks(export, fmt):
+    """Encoded output for `export`; an error mid-stream ends it early"""
+    encode = csv_chunks if fmt == "csv" else ndjson_chunks
+    try:
+        yield from encode(export.columns, export.rows())
+    except Exception as e:
+        # Headers are long gone, so a truncated file is all that can be signalled
+        logger.error("Export of %s failed: %s", export.table, e)
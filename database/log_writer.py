@@ -0,0 +1,174 @@
+import atexit
+import logging
+import threading
+import time
+from collections import deque
+from config import Config
+from .pool import get_db_connection, DatabaseUnavailable
+from .stats import record_log_stats
+from .events import announce, message_events, wants_events
+
+logger = logging.getLogger(__name__)
+
+LOG_COLUMNS = ("sender", "message", "response", "success", "error_message", "processing_time_ms")
+
+
+def copy_message_logs(rows):
+    """Write message_logs rows with a single COPY, update the rollups and tell live dashboards"""
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            with cursor.copy(f"COPY message_logs ({', '.join(LOG_COLUMNS)}) FROM STDIN") as copy:
+                for row in rows:
+                    copy.write_row(row)
+            record_log_stats(cursor, rows)
+            if wants_events():
+                announce(cursor, "messages", message_events(rows))
+
+
+class LogWriter:
+    """Buffers message_logs rows in memory and writes them in batches.
+
+    A background thread flushes with COPY once `batch_size` rows are
+    waiting or `flush_interval` seconds have passed since the last flush,
+    whichever comes first. The buffer holds at most `max_buffer` rows;
+    rows that arrive while it is full, or that belong to a batch the
+    database rejected, are dropped and counted rather than blocking the
+    caller. After stop(), rows are written synchronously instead.
+    """
+
+    def __init__(self, batch_size=200, flush_interval=0.5, max_buffer=10000):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self._buffer = deque()
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._stopped = False
+        self._thread = None
+        self.written = 0
+        self.dropped = 0
+        self.flush_errors = 0
+
+    def start(self):
+        with self._cond:
+            if self._thread is None and not self._stopped:
+                self._stopping = False
+                self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+                self._thread.start()
+
+    def write(self, row):
+        return self.write_many((row,))
+
+    def write_many(self, rows):
+        """Buffer rows for writing. Returns False if any had to be dropped."""
+        if self._stopped:
+            # Shutting down: nothing would flush a buffer any more
+            return self._write_batch(list(rows))
+        if self._thread is None:
+            self.start()
+        with self._cond:
+            room = self.max_buffer - len(self._buffer)
+            accepted = rows[:room] if room < len(rows) else rows
+            self._buffer.extend(accepted)
+            self.dropped += len(rows) - len(accepted)
+            if len(self._buffer) >= self.batch_size:
+                self._cond.notify()
+        return len(accepted) == len(rows)
+
+    def _take_batch(self):
+        with self._cond:
+            count = min(len(self._buffer), self.batch_size)
+            return [self._buffer.popleft() for _ in range(count)]
+
+    def _write_batch(self, batch):
+        try:
+            copy_message_logs(batch)
+            self.written += len(batch)
+            return True
+        except DatabaseUnavailable:
+            pass
+        except Exception as e:
+            logger.error("Error writing message logs: %s", e)
+        self.flush_errors += 1
+        self.dropped += len(batch)
+        return False
+
+    def flush(self):
+        """Write everything buffered so far"""
+        while True:
+            batch = self._take_batch()
+            if not batch:
+                return
+            self._write_batch(batch)
+
+    def _run(self):
+        while True:
+            deadline = time.monotonic() + self.flush_interval
+            with self._cond:
+                while not self._stopping and len(self._buffer) < self.batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                stopping = self._stopping
+            self.flush()
+            if stopping:
+                return
+
+    def stop(self, timeout=None):
+        """Flush the buffer and stop the writer thread; later writes go straight to the database"""
+        with self._cond:
+            thread = self._thread
+            self._thread = None
+            self._stopping = True
+            self._stopped = True
+            self._cond.notify()
+        if thread is not None:
+            thread.join(timeout)
+        # Also picks up rows buffered while the thread was finishing
+        self.flush()
+
+    def stats(self):
+        with self._cond:
+            buffered = len(self._buffer)
+        return {
+            "buffered": buffered,
+            "written": self.written,
+            "dropped": self.dropped,
+            "flush_errors": self.flush_errors,
+        }
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_log_writer():
+    """Return the process-wide buffered log writer"""
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = LogWriter(
+                    batch_size=Config.LOG_BATCH_SIZE,
+                    flush_interval=Config.LOG_FLUSH_INTERVAL_MS / 1000,
+                    max_buffer=Config.LOG_MAX_BUFFER,
+                )
+    return _writer
+
+
+def _stop_writer():
+    if _writer is not None:
+        _writer.stop(10)
+
+
+# Registered at import, ahead of the webhook pool and outbox drainer, so
+# atexit (last in, first out) drains those first and this final flush
+# sees what they logged. Anything logged later is written synchronously.
+atexit.register(_stop_writer)
+
+
+def get_log_writer_stats():
+    if _writer is None:
+        return {}
+    return _writer.stats()
@@ -0,0 +1,159 @@
+import datetime
+import logging
+import os
+import re
+import sys
+from applog import configure_logging
+from .pool import get_db_connection
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(__file__), "migrations")
+
+# Arbitrary key for pg_advisory_xact_lock, so only one process migrates at a time
+MIGRATION_LOCK_ID = 7254011
+
+def hot_queries():
+    """The queries on the message path and dashboard, with sample parameters.
+
+    The SQL comes from the same constants and builders the app runs, so
+    the check can't drift from them. check_query_plans() fails if any of
+    them plans a sequential scan.
+    """
+    # Imported here: models imports this module
+    from .models import (recent_messages_sql, message_page_query, pending_actions_sql,
+                         PENDING_ACTIONS_VERSION_SQL)
+    from .queries import (BALANCE_BY_PHONE_SQL, BALANCE_BY_PHONE_AND_ID_SQL, CHILDREN_WITH_TAGS_SQL,
+                          DEACTIVATE_CHILD_TAG_SQL)
+    from .stats import ACTIVE_USERS_SQL, PENDING_ACTIONS_COUNT_SQL
+
+    phone = "254712345678"
+    cursor = (datetime.datetime(2024, 1, 1), 1000)
+    since, until = datetime.datetime(2024, 1, 1), datetime.datetime(2024, 2, 1)
+    return [
+        ("get_recent_messages", recent_messages_sql(as_dicts=True), (50,)),
+        ("get_message_page", *message_page_query(50, cursor)),
+        ("get_message_page_by_sender", *message_page_query(50, cursor, sender=phone)),
+        ("get_message_page_failures", *message_page_query(50, success=False)),
+        ("get_message_page_successes", *message_page_query(50, cursor, success=True)),
+        ("get_message_page_window", *message_page_query(50, cursor, since=since, until=until)),
+        ("get_pending_actions", pending_actions_sql(as_dicts=True), ()),
+        ("pending_actions_version", PENDING_ACTIONS_VERSION_SQL, ()),
+        ("pending_actions_count", PENDING_ACTIONS_COUNT_SQL, ()),
+        ("active_users", ACTIVE_USERS_SQL, ()),
+        ("fetch_balance_by_phone", BALANCE_BY_PHONE_SQL, (phone,)),
+        ("fetch_balance_by_phone_and_id", BALANCE_BY_PHONE_AND_ID_SQL, (phone, "12345678")),
+        ("fetch_children_by_parent_phone", CHILDREN_WITH_TAGS_SQL, (phone,)),
+        ("deactivate_child_tag", DEACTIVATE_CHILD_TAG_SQL, (1,)),
+    ]
+
+
+def list_migrations():
+    """Return (version, name, path) for every migration file, in order"""
+    migrations = []
+    for filename in os.listdir(MIGRATIONS_DIR):
+        match = re.match(r"^(\d+)_(.+)\.sql$", filename)
+        if match:
+            migrations.append((int(match.group(1)), match.group(2), os.path.join(MIGRATIONS_DIR, filename)))
+    return sorted(migrations)
+
+
+def pending_migrations():
+    """Return the versions not applied yet, without applying them"""
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT to_regclass('schema_version') IS NOT NULL")
+            applied = set()
+            if cursor.fetchone()[0]:
+                cursor.execute("SELECT version FROM schema_version")
+                applied = {version for version, in cursor.fetchall()}
+    return [version for version, name, path in list_migrations() if version not in applied]
+
+
+def run_migrations():
+    """Apply pending migrations, each in its own transaction.
+
+    Returns the versions that were applied.
+    """
+    applied = []
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+        conn.commit()
+
+        for version, name, path in list_migrations():
+            with conn.transaction():
+                with conn.cursor() as cursor:
+                    # Other workers starting at the same time wait here, then
+                    # see the migration as already applied
+                    cursor.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK_ID,))
+                    cursor.execute("SELECT 1 FROM schema_version WHERE version = %s", (version,))
+                    if cursor.fetchone():
+                        continue
+
+                    with open(path, encoding="utf-8") as f:
+                        cursor.execute(f.read())
+                    cursor.execute(
+                        "INSERT INTO schema_version (version, name) VALUES (%s, %s)",
+                        (version, name)
+                    )
+                    applied.append(version)
+                    logger.info("Applied migration %04d_%s", version, name)
+    return applied
+
+
+def _seq_scans(plan):
+    """Yield the relations a JSON EXPLAIN plan reads with a sequential scan"""
+    if plan.get("Node Type") == "Seq Scan":
+        yield plan.get("Relation Name")
+    for child in plan.get("Plans", []):
+        yield from _seq_scans(child)
+
+
+def check_query_plans(queries=None):
+    """EXPLAIN every hot query and report any that need a sequential scan.
+
+    Sequential scans are disabled for the check, so the planner falls back
+    to one only when no usable index exists. That keeps the result stable
+    on small development databases, where a seq scan would otherwise be
+    the cheapest plan. Returns a list of (query name, relation) failures.
+    """
+    failures = []
+    with get_db_connection() as conn:
+        for name, sql, params in queries or hot_queries():
+            with conn.transaction():
+                with conn.cursor() as cursor:
+                    cursor.execute("SET LOCAL enable_seqscan = off")
+                    cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+                    plan = cursor.fetchone()[0][0]["Plan"]
+                    for relation in _seq_scans(plan):
+                        failures.append((name, relation))
+    return failures
+
+
+def main(argv):
+    configure_logging()
+    if "--check" in argv:
+        failures = check_query_plans()
+        for name, relation in failures:
+            print(f"❌ {name}: sequential scan on {relation}")
+        if failures:
+            return 1
+        print("✅ All hot queries use indexes")
+        return 0
+
+    applied = run_migrations()
+    if not applied:
+        print("Database schema is up to date")
+    return 0
+
+
+if __name__ == "__main__":
+    # python -m database.migrate [--check]
+    sys.exit(main(sys.argv[1:]))
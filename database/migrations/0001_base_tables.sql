@@ -0,0 +1,72 @@
+-- Tables the bot owns. IF NOT EXISTS so databases created by the old
+-- init_database() adopt this migration without changes.
+
+-- Message logs table
+CREATE TABLE IF NOT EXISTS message_logs (
+    id SERIAL PRIMARY KEY,
+    sender VARCHAR(20) NOT NULL,
+    message TEXT,
+    response TEXT,
+    success BOOLEAN DEFAULT TRUE,
+    error_message TEXT,
+    processing_time_ms INTEGER,
+    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Pending actions table
+CREATE TABLE IF NOT EXISTS pending_actions (
+    id SERIAL PRIMARY KEY,
+    action_type VARCHAR(50) NOT NULL,
+    sender VARCHAR(20) NOT NULL,
+    details JSONB,
+    status VARCHAR(20) DEFAULT 'pending',
+    admin_notes TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    processed_at TIMESTAMP NULL
+);
+
+-- Outbound message outbox
+CREATE TABLE IF NOT EXISTS outbox (
+    id BIGSERIAL PRIMARY KEY,
+    recipient VARCHAR(20) NOT NULL,
+    payload JSONB NOT NULL,
+    body TEXT,
+    status VARCHAR(20) DEFAULT 'pending',
+    attempts INTEGER DEFAULT 0,
+    last_error TEXT,
+    available_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    locked_until TIMESTAMP NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    sent_at TIMESTAMP NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_outbox_unsent
+    ON outbox (recipient, id)
+    WHERE status IN ('pending', 'sending');
+
+-- Dashboard rollups, kept up to date as message logs are written
+CREATE TABLE IF NOT EXISTS message_counters (
+    id SMALLINT PRIMARY KEY CHECK (id = 1),
+    total_messages BIGINT NOT NULL DEFAULT 0,
+    success_messages BIGINT NOT NULL DEFAULT 0
+);
+
+INSERT INTO message_counters (id, total_messages, success_messages)
+SELECT 1, COUNT(*), COUNT(*) FILTER (WHERE success)
+FROM message_logs
+ON CONFLICT (id) DO NOTHING;
+
+CREATE TABLE IF NOT EXISTS sender_activity (
+    sender VARCHAR(20) PRIMARY KEY,
+    last_seen TIMESTAMP NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_sender_activity_last_seen
+    ON sender_activity (last_seen);
+
+INSERT INTO sender_activity (sender, last_seen)
+SELECT sender, MAX(timestamp)
+FROM message_logs
+WHERE timestamp >= NOW() - INTERVAL '24 hours'
+GROUP BY sender
+ON CONFLICT (sender) DO NOTHING;
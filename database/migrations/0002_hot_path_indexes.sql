@@ -0,0 +1,40 @@
+-- Indexes for the queries in database/models.py and database/queries.py.
+-- Plain CREATE INDEX because each migration runs in a transaction; on a
+-- large live table, create the index CONCURRENTLY by hand first and this
+-- migration becomes a no-op.
+
+-- get_recent_messages: ORDER BY timestamp DESC LIMIT n
+CREATE INDEX IF NOT EXISTS idx_message_logs_timestamp
+    ON message_logs (timestamp DESC);
+
+-- Per-sender history
+CREATE INDEX IF NOT EXISTS idx_message_logs_sender_timestamp
+    ON message_logs (sender, timestamp DESC);
+
+-- get_pending_actions and the dashboard pending count
+CREATE INDEX IF NOT EXISTS idx_pending_actions_status_created
+    ON pending_actions (status, created_at DESC);
+
+-- parent, child and tag are owned by the school system, so only index
+-- them when they exist in this database.
+DO $$
+BEGIN
+    IF to_regclass('parent') IS NOT NULL THEN
+        -- Balance lookups, verify_parent and every children query
+        CREATE INDEX IF NOT EXISTS idx_parent_phone_number
+            ON parent (phone_number);
+    END IF;
+
+    IF to_regclass('child') IS NOT NULL THEN
+        -- JOIN parent p ON c.parent_id = p.id
+        CREATE INDEX IF NOT EXISTS idx_child_parent_id
+            ON child (parent_id);
+    END IF;
+
+    IF to_regclass('tag') IS NOT NULL THEN
+        -- Active tag lookups and deactivate_child_tag
+        CREATE INDEX IF NOT EXISTS idx_tag_child_id_status
+            ON tag (child_id, status);
+    END IF;
+END
+$$;
@@ -0,0 +1,10 @@
+-- Shared conversation sessions for STATE_BACKEND=postgres. UNLOGGED:
+-- cheap to write, and losing it in a crash only resets conversations.
+CREATE UNLOGGED TABLE IF NOT EXISTS conversation_state (
+    sender VARCHAR(20) PRIMARY KEY,
+    data JSONB NOT NULL,
+    expires_at TIMESTAMP NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_conversation_state_expires_at
+    ON conversation_state (expires_at);
@@ -0,0 +1,47 @@
+-- WhatsApp message ids already accepted, for DEDUP_BACKEND=postgres
+CREATE TABLE IF NOT EXISTS processed_messages (
+    message_id TEXT PRIMARY KEY,
+    seen_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_processed_messages_seen_at
+    ON processed_messages (seen_at);
+
+-- Existing duplicate pending requests would block the unique indexes
+-- below. Keep the oldest of each and mark the rest, rather than delete
+-- anything an admin may be looking at.
+UPDATE pending_actions p
+SET status = 'duplicate'
+WHERE p.status = 'pending'
+  AND p.action_type = 'tag_replacement'
+  AND EXISTS (
+      SELECT 1 FROM pending_actions o
+      WHERE o.status = 'pending'
+        AND o.action_type = 'tag_replacement'
+        AND o.sender = p.sender
+        AND o.details->>'child_id' = p.details->>'child_id'
+        AND o.id < p.id
+  );
+
+UPDATE pending_actions p
+SET status = 'duplicate'
+WHERE p.status = 'pending'
+  AND p.action_type = 'phone_change'
+  AND EXISTS (
+      SELECT 1 FROM pending_actions o
+      WHERE o.status = 'pending'
+        AND o.action_type = 'phone_change'
+        AND o.sender = p.sender
+        AND o.details->>'new_phone' = p.details->>'new_phone'
+        AND o.id < p.id
+  );
+
+-- At most one open replacement per child ...
+CREATE UNIQUE INDEX IF NOT EXISTS uq_pending_tag_replacement
+    ON pending_actions (sender, (details->>'child_id'))
+    WHERE status = 'pending' AND action_type = 'tag_replacement';
+
+-- ... and one open request per requested phone number
+CREATE UNIQUE INDEX IF NOT EXISTS uq_pending_phone_change
+    ON pending_actions (sender, (details->>'new_phone'))
+    WHERE status = 'pending' AND action_type = 'phone_change';
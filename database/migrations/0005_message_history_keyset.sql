@@ -0,0 +1,21 @@
+-- Indexes for the paginated message history (get_message_page), which
+-- pages on (timestamp, id) so rows sharing a timestamp are neither
+-- skipped nor repeated. Each replaces the matching index from 0002; see
+-- that file about creating them CONCURRENTLY on a large table.
+
+-- All messages, newest first; also serves ORDER BY timestamp DESC LIMIT n
+CREATE INDEX IF NOT EXISTS idx_message_logs_timestamp_id
+    ON message_logs (timestamp DESC, id DESC);
+
+DROP INDEX IF EXISTS idx_message_logs_timestamp;
+
+-- One sender's history
+CREATE INDEX IF NOT EXISTS idx_message_logs_sender_timestamp_id
+    ON message_logs (sender, timestamp DESC, id DESC);
+
+DROP INDEX IF EXISTS idx_message_logs_sender_timestamp;
+
+-- The "Errors" view: failures are rare, so a partial index stays small
+CREATE INDEX IF NOT EXISTS idx_message_logs_failed_timestamp_id
+    ON message_logs (timestamp DESC, id DESC)
+    WHERE NOT success;
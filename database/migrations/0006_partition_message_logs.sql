@@ -0,0 +1,92 @@
+-- Range-partition message_logs by month on timestamp, so old months can
+-- be detached and archived whole (database/partitions.py) instead of
+-- bloating one ever-growing heap, and time-bounded queries only touch
+-- the months they cover.
+--
+-- No rows are copied. The existing table becomes the first partition,
+-- message_logs_legacy, covering everything up to the end of this month;
+-- monthly partitions take over from next month. Its existing indexes are
+-- reused by the partitioned ones. What remains is proportional to one
+-- pass over the table: backfilling NULL timestamps, validating the range
+-- CHECK (which lets ATTACH and SET NOT NULL skip their own scans) and
+-- building the (id, timestamp) primary key. Maintenance retires the
+-- legacy partition whole once all of it is past retention, or on demand
+-- (see database/partitions.py).
+
+DO $$
+DECLARE
+    -- Dates only, so %L-quoted literals are safe; DDL can't take parameters
+    this_month DATE := date_trunc('month', NOW())::date;
+    legacy_end DATE := (date_trunc('month', NOW()) + INTERVAL '1 month')::date;
+BEGIN
+    ALTER TABLE message_logs RENAME TO message_logs_legacy;
+    -- Free the index names for the partitioned table
+    ALTER INDEX idx_message_logs_timestamp_id RENAME TO message_logs_legacy_timestamp_id_idx;
+    ALTER INDEX idx_message_logs_sender_timestamp_id RENAME TO message_logs_legacy_sender_timestamp_id_idx;
+    ALTER INDEX idx_message_logs_failed_timestamp_id RENAME TO message_logs_legacy_failed_timestamp_id_idx;
+
+    -- The partition key can't be NULL
+    UPDATE message_logs_legacy SET timestamp = 'epoch' WHERE timestamp IS NULL;
+    EXECUTE format(
+        'ALTER TABLE message_logs_legacy ADD CONSTRAINT message_logs_legacy_range '
+        'CHECK (timestamp IS NOT NULL AND timestamp < %L)',
+        legacy_end
+    );
+    ALTER TABLE message_logs_legacy ALTER COLUMN timestamp SET NOT NULL;
+    -- A partition's primary key must match the parent's (id, timestamp)
+    CREATE UNIQUE INDEX message_logs_legacy_id_timestamp_key ON message_logs_legacy (id, timestamp);
+    ALTER TABLE message_logs_legacy DROP CONSTRAINT message_logs_pkey;
+    ALTER TABLE message_logs_legacy ADD CONSTRAINT message_logs_legacy_pkey
+        PRIMARY KEY USING INDEX message_logs_legacy_id_timestamp_key;
+
+    -- The partition key has to be part of the primary key. ids still come
+    -- from the original sequence, so they stay unique in practice.
+    CREATE TABLE message_logs (
+        id INTEGER NOT NULL DEFAULT nextval('message_logs_id_seq'),
+        sender VARCHAR(20) NOT NULL,
+        message TEXT,
+        response TEXT,
+        success BOOLEAN DEFAULT TRUE,
+        error_message TEXT,
+        processing_time_ms INTEGER,
+        timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (id, timestamp)
+    ) PARTITION BY RANGE (timestamp);
+
+    ALTER SEQUENCE message_logs_id_seq OWNED BY message_logs.id;
+
+    -- Same indexes as 0005; the legacy partition's matching ones are attached, not rebuilt
+    CREATE INDEX idx_message_logs_timestamp_id
+        ON message_logs (timestamp DESC, id DESC);
+
+    CREATE INDEX idx_message_logs_sender_timestamp_id
+        ON message_logs (sender, timestamp DESC, id DESC);
+
+    CREATE INDEX idx_message_logs_failed_timestamp_id
+        ON message_logs (timestamp DESC, id DESC)
+        WHERE NOT success;
+
+    EXECUTE format(
+        'ALTER TABLE message_logs ATTACH PARTITION message_logs_legacy FOR VALUES FROM (MINVALUE) TO (%L)',
+        legacy_end
+    );
+    -- The partition bound says the same now
+    ALTER TABLE message_logs_legacy DROP CONSTRAINT message_logs_legacy_range;
+
+    -- Catches rows no partition covers yet, so a missed maintenance run
+    -- never fails an insert. create_partition() moves them out again.
+    CREATE TABLE message_logs_default PARTITION OF message_logs DEFAULT;
+
+    -- The next three months, so new rows have somewhere to go; deploys
+    -- run `python -m database.partitions --upcoming` after migrating,
+    -- which extends this to PARTITION_MONTHS_AHEAD
+    FOR offset_months IN 1..3 LOOP
+        EXECUTE format(
+            'CREATE TABLE %I PARTITION OF message_logs FOR VALUES FROM (%L) TO (%L)',
+            'message_logs_p' || to_char(this_month + make_interval(months => offset_months), 'YYYYMM'),
+            (this_month + make_interval(months => offset_months))::date,
+            (this_month + make_interval(months => offset_months + 1))::date
+        );
+    END LOOP;
+END
+$$;
@@ -0,0 +1,5 @@
+-- Bumped whenever message_logs rows are retired in bulk (detached
+-- partitions), so the messages version that /api/messages tags pages
+-- with can't come back round to an old value as new rows arrive.
+ALTER TABLE message_counters
+    ADD COLUMN IF NOT EXISTS generation INTEGER NOT NULL DEFAULT 0;
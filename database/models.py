@@ -1,187 +1,309 @@
-import psycopg
-from config import DATABASE_CONFIG
+import base64
+import datetime
+import logging
+from psycopg.rows import dict_row, tuple_row
+from psycopg.types.json import Jsonb
+from config import Config
+from .pool import get_db_connection, DatabaseUnavailable
+from .outbox import enqueue_outbox
+from .events import announce
+from .log_writer import copy_message_logs, get_log_writer
+from .stats import MetricsCache, read_dashboard_metrics
+from .migrate import pending_migrations
 
-def get_db_connection():
-    """Get database connection"""
-    try:
-        conn = psycopg.connect(**DATABASE_CONFIG)
-        return conn
-    except psycopg.Error as e:
-        print(f"Database connection error: {e}")
-        return None
+logger = logging.getLogger(__name__)
 
-def init_database():
-    """Initialize database tables"""
-    conn = get_db_connection()
-    if not conn:
-        return False
-    
+_metrics_cache = MetricsCache(Config.METRICS_CACHE_TTL)
+
+def formatted_timestamp(column):
+    # Qualified ORDER BY columns below still sort by the raw timestamp
+    return f"to_char({column}, 'YYYY-MM-DD HH24:MI:SS') AS {column}"
+
+def recent_messages_sql(as_dicts=False):
+    """The query get_recent_messages() runs; takes the limit"""
+    return f"""
+        SELECT id, sender, message, response, success, error_message,
+               {formatted_timestamp('timestamp') if as_dicts else 'timestamp'}
+        FROM message_logs
+        ORDER BY message_logs.timestamp DESC
+        LIMIT %s
+    """
+
+def message_page_query(limit, cursor=None, sender=None, success=None, since=None, until=None):
+    """(sql, params) for get_message_page(), fetching one row past `limit`"""
+    conditions, params = [], []
+    if cursor is not None:
+        conditions.append("(timestamp, id) < (%s, %s)")
+        params.extend(cursor)
+    if sender is not None:
+        conditions.append("sender = %s")
+        params.append(sender)
+    if success is not None:
+        # A literal rather than a parameter, so failures can use the partial index
+        conditions.append("success" if success else "NOT success")
+    if since is not None:
+        conditions.append("timestamp >= %s")
+        params.append(since)
+    if until is not None:
+        conditions.append("timestamp < %s")
+        params.append(until)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    # The extra row says whether there is another page
+    return f"""
+        SELECT id, sender, message, response, success, error_message,
+               {formatted_timestamp('timestamp')},
+               message_logs.timestamp AS sort_timestamp
+        FROM message_logs
+        {where}
+        ORDER BY message_logs.timestamp DESC, id DESC
+        LIMIT %s
+    """, (*params, limit + 1)
+
+def pending_actions_sql(as_dicts=False):
+    """The query get_pending_actions() runs"""
+    return f"""
+        SELECT id, action_type, sender, details,
+               {formatted_timestamp('created_at') if as_dicts else 'created_at'}
+        FROM pending_actions
+        WHERE status = 'pending'
+        ORDER BY pending_actions.created_at DESC
+    """
+
+PENDING_ACTIONS_VERSION_SQL = """
+    SELECT COUNT(*), COALESCE(MAX(id), 0), COALESCE(SUM(id), 0)
+    FROM pending_actions
+    WHERE status = 'pending'
+"""
+
+def check_schema():
+    """Warn if migrations are pending.
+
+    They aren't applied here: a long migration would hold up every worker
+    past gunicorn's timeout. Deploys run `python -m database.migrate`
+    first (render.yaml's preDeployCommand).
+    """
     try:
-        with conn.cursor() as cursor:
-            # Message logs table
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS message_logs (
-                    id SERIAL PRIMARY KEY,
-                    sender VARCHAR(20) NOT NULL,
-                    message TEXT,
-                    response TEXT,
-                    success BOOLEAN DEFAULT TRUE,
-                    error_message TEXT,
-                    processing_time_ms INTEGER,
-                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-            
-            # Pending actions table
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS pending_actions (
-                    id SERIAL PRIMARY KEY,
-                    action_type VARCHAR(50) NOT NULL,
-                    sender VARCHAR(20) NOT NULL,
-                    details JSONB,
-                    status VARCHAR(20) DEFAULT 'pending',
-                    admin_notes TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    processed_at TIMESTAMP NULL
-                )
-            """)
-            
-            conn.commit()
-            return True
-            
+        pending = pending_migrations()
+    except DatabaseUnavailable:
+        return False
     except Exception as e:
-        print("Database initialization error:", e)
-        conn.rollback()
+        logger.error("Error checking database schema: %s", e)
         return False
-    finally:
-        conn.close()
+    if pending:
+        logger.warning("Database schema is behind; run `python -m database.migrate` to apply %s",
+                       ", ".join(f"{version:04d}" for version in pending))
+    return not pending
 
 def log_message(sender, message, response, success=True, error_message=None, processing_time=None):
     """Log message to database"""
-    conn = get_db_connection()
-    if not conn:
-        return False
-    
+    return log_messages([(sender, message, response, success, error_message, processing_time)])
+
+def log_messages(rows):
+    """Log a batch of messages in one round trip.
+
+    rows are (sender, message, response, success, error_message, processing_time) tuples.
+    With LOG_BUFFERED on they are handed to the background log writer
+    instead, which batches them with rows from other requests.
+    """
+    if not rows:
+        return True
+
+    if Config.LOG_BUFFERED:
+        return get_log_writer().write_many(rows)
+
     try:
-        with conn.cursor() as cursor:
-            cursor.execute("""
-                INSERT INTO message_logs (sender, message, response, success, error_message, processing_time_ms)
-                VALUES (%s, %s, %s, %s, %s, %s)
-            """, (sender, message, response, success, error_message, processing_time))
-            conn.commit()
-            return True
+        copy_message_logs(rows)
+        return True
+    except DatabaseUnavailable:
+        return False
     except Exception as e:
-        print("Error logging message:", e)
-        conn.rollback()
+        logger.error("Error logging messages: %s", e)
         return False
-    finally:
-        conn.close()
 
-def add_pending_action(action_type, sender, details):
-    """Add pending action to database"""
-    conn = get_db_connection()
-    if not conn:
-        return False
-    
+def add_pending_action(action_type, sender, details, reply=None):
+    """Add pending action to database.
+
+    reply is an optional (payload, body) outbound message that is queued in
+    the outbox within the same transaction. A repeat of a request that is
+    still pending adds nothing, but its reply is queued all the same.
+    """
     try:
-        with conn.cursor() as cursor:
-            cursor.execute("""
-                INSERT INTO pending_actions (action_type, sender, details)
-                VALUES (%s, %s, %s)
-            """, (action_type, sender, details))
-            conn.commit()
+        with get_db_connection() as conn:
+            with conn.cursor() as cursor:
+                # The unique indexes on pending_actions turn a repeated request into a no-op
+                cursor.execute(f"""
+                    INSERT INTO pending_actions (action_type, sender, details)
+                    VALUES (%s, %s, %s)
+                    ON CONFLICT DO NOTHING
+                    RETURNING id, {formatted_timestamp('created_at')}
+                """, (action_type, sender, Jsonb(details)))
+                row = cursor.fetchone()
+                if row is not None:
+                    announce_pending_action(cursor, row, action_type, sender, details)
+                if reply:
+                    payload, body = reply
+                    enqueue_outbox(cursor, sender, payload, body)
             return True
+    except DatabaseUnavailable:
+        return False
     except Exception as e:
-        print("Error adding pending action:", e)
-        conn.rollback()
+        logger.error("Error adding pending action: %s", e)
         return False
-    finally:
-        conn.close()
 
-def get_recent_messages(limit=50):
-    """Get recent messages from database"""
-    conn = get_db_connection()
-    if not conn:
-        return []
-    
+def announce_pending_action(cursor, row, action_type, sender, details):
+    """Push a just-inserted pending action (row is its id, created_at) to live dashboards"""
+    action_id, created_at = row
+    announce(cursor, "pending_action", {
+        "id": action_id,
+        "action_type": action_type,
+        "sender": sender,
+        "details": details,
+        "created_at": created_at,
+    })
+
+def refresh_dashboard_metrics():
+    """Recompute the dashboard metrics now rather than serving the cached copy"""
+    _metrics_cache.invalidate()
+    return get_dashboard_metrics()
+
+def get_recent_messages(limit=50, as_dicts=False):
+    """Get recent messages from database.
+
+    With as_dicts, rows come back as dicts with the timestamp already
+    formatted, ready to be JSON-encoded as they are.
+    """
     try:
-        with conn.cursor() as cursor:
-            cursor.execute("""
-                SELECT id, sender, message, response, success, error_message, timestamp 
-                FROM message_logs 
-                ORDER BY timestamp DESC 
-                LIMIT %s
-            """, (limit,))
-            return cursor.fetchall()
+        with get_db_connection() as conn:
+            with conn.cursor(row_factory=dict_row if as_dicts else tuple_row) as cursor:
+                cursor.execute(recent_messages_sql(as_dicts), (limit,))
+                return cursor.fetchall()
+    except DatabaseUnavailable:
+        return []
     except Exception as e:
-        print("Error fetching messages:", e)
+        logger.error("Error fetching messages: %s", e)
         return []
-    finally:
-        conn.close()
 
-def get_pending_actions():
-    """Get pending actions from database"""
-    conn = get_db_connection()
-    if not conn:
-        return []
-    
+def encode_message_cursor(timestamp, message_id):
+    """Opaque next-page token for the row at (timestamp, message_id)"""
+    return base64.urlsafe_b64encode(f"{timestamp.isoformat()}|{message_id}".encode("utf-8")).decode("ascii")
+
+def decode_message_cursor(token):
+    """Inverse of encode_message_cursor; raises ValueError for a bad token"""
+    try:
+        timestamp, _, message_id = base64.urlsafe_b64decode(token.encode("ascii")).decode("utf-8").partition("|")
+        return datetime.datetime.fromisoformat(timestamp), int(message_id)
+    except (UnicodeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor: {token!r}") from e
+
+def get_message_page(limit, cursor=None, sender=None, success=None, since=None, until=None):
+    """One page of message history, newest first, as dicts.
+
+    Pages are keyed on (timestamp, id) rather than OFFSET, so every page
+    is an index range scan however deep it is. `cursor` is the
+    next_cursor of the previous page (see decode_message_cursor). `since`
+    is inclusive and `until` exclusive. Returns (rows, next_cursor), with
+    next_cursor None on the last page.
+    """
+    sql, params = message_page_query(limit, cursor, sender, success, since, until)
+    try:
+        with get_db_connection() as conn:
+            with conn.cursor(row_factory=dict_row) as db_cursor:
+                db_cursor.execute(sql, params)
+                rows = db_cursor.fetchall()
+    except DatabaseUnavailable:
+        return [], None
+    except Exception as e:
+        logger.error("Error fetching message page: %s", e)
+        return [], None
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_message_cursor(rows[-1]["sort_timestamp"], rows[-1]["id"])
+    for row in rows:
+        del row["sort_timestamp"]
+    return rows, next_cursor
+
+def get_pending_actions(as_dicts=False):
+    """Get pending actions from database (as_dicts: see get_recent_messages)"""
     try:
-        with conn.cursor() as cursor:
-            cursor.execute("""
-                SELECT id, action_type, sender, details, created_at
-                FROM pending_actions 
-                WHERE status = 'pending'
-                ORDER BY created_at DESC
-            """)
-            return cursor.fetchall()
+        with get_db_connection() as conn:
+            with conn.cursor(row_factory=dict_row if as_dicts else tuple_row) as cursor:
+                cursor.execute(pending_actions_sql(as_dicts))
+                return cursor.fetchall()
+    except DatabaseUnavailable:
+        return []
     except Exception as e:
-        print("Error fetching pending actions:", e)
+        logger.error("Error fetching pending actions: %s", e)
         return []
-    finally:
-        conn.close()
 
-def get_dashboard_metrics():
-    """Get metrics for dashboard"""
-    conn = get_db_connection()
-    if not conn:
-        return {}
-    
+def _load_dashboard_metrics():
+    try:
+        with get_db_connection() as conn:
+            with conn.cursor() as cursor:
+                return read_dashboard_metrics(cursor)
+    except DatabaseUnavailable:
+        return None
+    except Exception as e:
+        logger.error("Error fetching metrics: %s", e)
+        return None
+
+def get_dashboard_metrics_version():
+    """Token that changes whenever get_dashboard_metrics() would return new figures"""
+    if _metrics_cache.get(_load_dashboard_metrics) is None:
+        return None
+    return _metrics_cache.version
+
+def get_messages_version():
+    """Token that changes whenever a message is logged or old ones are retired.
+
+    message_counters is updated in the same transaction as every
+    message_logs insert, so this is one primary-key read that can't run
+    ahead of or behind the rows. Its generation goes up when partitions
+    are detached (database/partitions.py), so the count coming back to
+    an earlier value doesn't revive an old token.
+    """
+    try:
+        with get_db_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT generation, total_messages FROM message_counters WHERE id = 1")
+                row = cursor.fetchone()
+                return f"{row[0]}.{row[1]}" if row else "0.0"
+    except DatabaseUnavailable:
+        return None
+    except Exception as e:
+        logger.error("Error fetching messages version: %s", e)
+        return None
+
+def get_pending_actions_version():
+    """Token that changes whenever the set of pending actions changes"""
     try:
-        with conn.cursor() as cursor:
-            # Total messages
-            cursor.execute("SELECT COUNT(*) FROM message_logs")
-            total_messages = cursor.fetchone()[0] or 0
-            
-            # Success rate
-            cursor.execute("SELECT COUNT(*) FROM message_logs WHERE success = true")
-            success_count = cursor.fetchone()[0] or 0
-            success_rate = round((success_count / total_messages * 100), 1) if total_messages > 0 else 0
-            
-            # Active users (last 24h)
-            cursor.execute("""
-                SELECT COUNT(DISTINCT sender) 
-                FROM message_logs 
-                WHERE timestamp >= NOW() - INTERVAL '24 hours'
-            """)
-            active_users = cursor.fetchone()[0] or 0
-            
-            # Pending actions
-            cursor.execute("SELECT COUNT(*) FROM pending_actions WHERE status = 'pending'")
-            pending_actions = cursor.fetchone()[0] or 0
-            
-            return {
-                'total_messages': total_messages,
-                'success_rate': success_rate,
-                'active_users': active_users,
-                'pending_actions': pending_actions
-            }
+        with get_db_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(PENDING_ACTIONS_VERSION_SQL)
+                return "-".join(str(value) for value in cursor.fetchone())
+    except DatabaseUnavailable:
+        return None
     except Exception as e:
-        print("Error fetching metrics:", e)
+        logger.error("Error fetching pending actions version: %s", e)
+        return None
+
+def get_dashboard_metrics():
+    """Get metrics for dashboard.
+
+    Answered from the message_counters and sender_activity rollups rather
+    than by scanning message_logs, and cached for METRICS_CACHE_TTL
+    seconds. The figures can therefore lag the log by at most
+    LOG_FLUSH_INTERVAL_MS (buffered rows not yet written) plus
+    METRICS_CACHE_TTL.
+    """
+    metrics = _metrics_cache.get(_load_dashboard_metrics)
+    if metrics is None:
         return {
             'total_messages': 0,
             'success_rate': 0,
             'active_users': 0,
             'pending_actions': 0
         }
-    finally:
-        conn.close()
+    return metrics
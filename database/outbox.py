@@ -0,0 +1,114 @@
+import logging
+from psycopg.types.json import Jsonb
+from .pool import get_db_connection, DatabaseUnavailable
+
+logger = logging.getLogger(__name__)
+
+def enqueue_outbox(cursor, recipient, payload, body=None):
+    """Queue an outbound message using the caller's cursor.
+
+    Use this inside the transaction that makes the state change the
+    message reports, so both commit or roll back together.
+    """
+    cursor.execute("""
+        INSERT INTO outbox (recipient, payload, body)
+        VALUES (%s, %s, %s)
+    """, (recipient, Jsonb(payload), body))
+
+def queue_message(recipient, payload, body=None):
+    """Queue an outbound message in its own transaction"""
+    try:
+        with get_db_connection() as conn:
+            with conn.cursor() as cursor:
+                enqueue_outbox(cursor, recipient, payload, body)
+            return True
+    except DatabaseUnavailable:
+        return False
+    except Exception as e:
+        logger.error("Error queueing outbound message: %s", e)
+        return False
+
+def claim_outbox_batch(limit, lease_seconds):
+    """Claim up to `limit` due messages for sending.
+
+    Rows are locked with FOR UPDATE SKIP LOCKED so concurrent drainers,
+    on this node or others, never claim the same row. A claimed row is
+    leased for `lease_seconds`; if the drainer dies before finishing it,
+    the row becomes claimable again, which makes delivery at-least-once.
+    Only the oldest unsent message per recipient is eligible, which keeps
+    each parent's replies in order.
+    """
+    try:
+        with get_db_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    UPDATE outbox
+                    SET status = 'sending',
+                        attempts = attempts + 1,
+                        locked_until = NOW() + %s * INTERVAL '1 second'
+                    WHERE id IN (
+                        SELECT o.id
+                        FROM outbox o
+                        WHERE ((o.status = 'pending' AND o.available_at <= NOW())
+                               OR (o.status = 'sending' AND o.locked_until < NOW()))
+                          AND NOT EXISTS (
+                            SELECT 1 FROM outbox e
+                            WHERE e.recipient = o.recipient
+                              AND e.status IN ('pending', 'sending')
+                              AND e.id < o.id
+                        )
+                        ORDER BY o.id
+                        LIMIT %s
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING id, recipient, payload, body, attempts
+                """, (lease_seconds, limit))
+                return cursor.fetchall()
+    except DatabaseUnavailable:
+        return []
+    except Exception as e:
+        logger.error("Error claiming outbox batch: %s", e)
+        return []
+
+def complete_outbox(sent_ids, retry_rows, failed_rows, released_ids=()):
+    """Record the outcome of a drained batch in one transaction.
+
+    retry_rows are (delay_seconds, error, id) and failed_rows are (error, id).
+    released_ids were claimed but not attempted; they become claimable
+    again at once, without the claim counting as an attempt.
+    """
+    try:
+        with get_db_connection() as conn:
+            with conn.cursor() as cursor:
+                if sent_ids:
+                    cursor.execute("""
+                        UPDATE outbox
+                        SET status = 'sent', sent_at = NOW(), locked_until = NULL, last_error = NULL
+                        WHERE id = ANY(%s)
+                    """, (list(sent_ids),))
+                if retry_rows:
+                    cursor.executemany("""
+                        UPDATE outbox
+                        SET status = 'pending', locked_until = NULL,
+                            available_at = NOW() + %s * INTERVAL '1 second',
+                            last_error = %s
+                        WHERE id = %s
+                    """, retry_rows)
+                if released_ids:
+                    cursor.execute("""
+                        UPDATE outbox
+                        SET status = 'pending', locked_until = NULL, attempts = attempts - 1
+                        WHERE id = ANY(%s)
+                    """, (list(released_ids),))
+                if failed_rows:
+                    cursor.executemany("""
+                        UPDATE outbox
+                        SET status = 'failed', locked_until = NULL, last_error = %s
+                        WHERE id = %s
+                    """, failed_rows)
+            return True
+    except DatabaseUnavailable:
+        return False
+    except Exception as e:
+        logger.error("Error updating outbox: %s", e)
+        return False
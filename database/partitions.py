@@ -0,0 +1,274 @@
+"""Monthly partitions of message_logs: creating them ahead, retiring old ones.
+
+message_logs is range-partitioned on timestamp, one partition per month
+named message_logs_pYYYYMM, plus message_logs_default for anything no
+partition covers. Rows from before migration 0006 stay in
+message_logs_legacy, which covers everything up to the end of the month
+the migration ran in. run_maintenance():
+
+- creates the partitions for this month and the next
+  PARTITION_MONTHS_AHEAD months;
+- detaches partitions that ended more than PARTITION_RETENTION_MONTHS
+  months ago (0 keeps everything), taking their rows off the
+  message_counters totals. By default (PARTITION_EXPIRY=detach)
+  they stay in the database as ordinary tables. With
+  PARTITION_EXPIRY=archive each is written to
+  PARTITION_ARCHIVE_DIR/<name>.csv.gz and dropped; that directory must
+  already exist and should be a persistent disk, and nothing is detached
+  or dropped if it isn't set.
+
+The legacy partition can only be retired whole, so it goes once its
+newest month is past retention: until then, rows from before the
+migration are kept up to PARTITION_RETENTION_MONTHS longer than the
+setting says. To reclaim that space sooner, retire it early with
+`python -m database.partitions --retire-legacy`, which handles it
+exactly like an expired month, whatever its age.
+
+Run it daily with `python -m database.partitions`; deploys run it with
+--upcoming, which only creates partitions, right after migrating.
+"""
+import datetime
+import gzip
+import logging
+import os
+import re
+import sys
+from applog import configure_logging
+from config import Config
+from .pool import get_db_connection, DatabaseUnavailable
+
+logger = logging.getLogger(__name__)
+
+PARENT = "message_logs"
+DEFAULT_PARTITION = "message_logs_default"
+LEGACY_PARTITION = "message_logs_legacy"
+PARTITION_PATTERN = re.compile(r"^message_logs_p(\d{4})(\d{2})$")
+
+# Arbitrary key for pg_advisory_xact_lock, so only one process does maintenance at a time
+MAINTENANCE_LOCK_ID = 7254012
+
+
+def add_months(month, months):
+    years, index = divmod(month.month - 1 + months, 12)
+    return datetime.date(month.year + years, index + 1, 1)
+
+
+def partition_name(month):
+    return f"{PARENT}_p{month:%Y%m}"
+
+
+def _lock(cursor):
+    cursor.execute("SELECT pg_advisory_xact_lock(%s)", (MAINTENANCE_LOCK_ID,))
+
+
+def list_partitions(cursor):
+    """Return (month, attached) for every message_logs_pYYYYMM table, oldest first"""
+    cursor.execute("""
+        SELECT relname, relispartition
+        FROM pg_class
+        WHERE relkind = 'r' AND relname ~ '^message_logs_p[0-9]{6}$' AND pg_table_is_visible(oid)
+    """)
+    partitions = []
+    for name, attached in cursor.fetchall():
+        match = PARTITION_PATTERN.match(name)
+        if match:
+            partitions.append((datetime.date(int(match.group(1)), int(match.group(2)), 1), attached))
+    return sorted(partitions)
+
+
+def legacy_partition(cursor):
+    """(end, attached) for the legacy partition, or None if it's gone.
+
+    `end` is the first month it doesn't cover; None once it is detached.
+    """
+    cursor.execute("""
+        SELECT relispartition, pg_get_expr(relpartbound, oid)
+        FROM pg_class
+        WHERE oid = to_regclass(%s)
+    """, (LEGACY_PARTITION,))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    attached, bound = row
+    # FOR VALUES FROM (MINVALUE) TO ('2024-07-01 00:00:00')
+    match = re.search(r"TO \('(\d{4})-(\d{2})-01", bound) if attached and bound else None
+    end = datetime.date(int(match.group(1)), int(match.group(2)), 1) if match else None
+    return end, attached
+
+
+def expired_partitions(cursor, cutoff, retire_legacy=False):
+    """(name, attached) for every partition past retention, oldest first"""
+    expired = [(partition_name(month), attached) for month, attached in list_partitions(cursor)
+               if add_months(month, 1) <= cutoff]
+    legacy = legacy_partition(cursor)
+    if legacy is not None:
+        end, attached = legacy
+        # A detached legacy partition was expired when it was detached
+        if retire_legacy or not attached or (end is not None and end <= cutoff):
+            expired.insert(0, (LEGACY_PARTITION, attached))
+    return expired
+
+
+def detach_partitions(cursor, names):
+    """Detach partitions, taking their rows off the message_counters totals"""
+    total = success = 0
+    for name in names:
+        cursor.execute(f"SELECT COUNT(*), COUNT(*) FILTER (WHERE success) FROM {name}")
+        rows, successes = cursor.fetchone()
+        total += rows
+        success += successes
+        cursor.execute(f"ALTER TABLE {PARENT} DETACH PARTITION {name}")
+    if names:
+        # The generation bump also retires cached /api/messages pages that showed these rows
+        cursor.execute("""
+            UPDATE message_counters
+            SET total_messages = GREATEST(total_messages - %s, 0),
+                success_messages = GREATEST(success_messages - %s, 0),
+                generation = generation + 1
+            WHERE id = 1
+        """, (total, success))
+
+
+def create_partition(cursor, month):
+    """Create and attach the partition for `month` if it doesn't exist yet.
+
+    Rows for that month already sitting in the default partition are
+    moved into it first; attaching would fail otherwise. Returns whether
+    a partition was created.
+    """
+    name = partition_name(month)
+    cursor.execute("SELECT to_regclass(%s)", (name,))
+    if cursor.fetchone()[0] is not None:
+        return False
+
+    # Dates only, so literals are safe; DDL can't take parameters
+    start, end = month.isoformat(), add_months(month, 1).isoformat()
+    cursor.execute(f"CREATE TABLE {name} (LIKE {PARENT} INCLUDING DEFAULTS)")
+    cursor.execute(f"""
+        WITH moved AS (
+            DELETE FROM {DEFAULT_PARTITION}
+            WHERE timestamp >= '{start}' AND timestamp < '{end}'
+            RETURNING *
+        )
+        INSERT INTO {name} SELECT * FROM moved
+    """)
+    if cursor.rowcount:
+        logger.warning("Moved %s rows from %s into %s", cursor.rowcount, DEFAULT_PARTITION, name)
+    cursor.execute(f"ALTER TABLE {PARENT} ATTACH PARTITION {name} FOR VALUES FROM ('{start}') TO ('{end}')")
+    return True
+
+
+def create_upcoming(cursor, today):
+    """Create this month's partition and the next PARTITION_MONTHS_AHEAD; returns the new names"""
+    this_month = today.replace(day=1)
+    legacy = legacy_partition(cursor)
+    covered_until = legacy[0] if legacy else None
+    created = []
+    for offset in range(Config.PARTITION_MONTHS_AHEAD + 1):
+        month = add_months(this_month, offset)
+        if covered_until and month < covered_until:
+            continue
+        if create_partition(cursor, month):
+            created.append(partition_name(month))
+    return created
+
+
+def archive_dir():
+    """PARTITION_ARCHIVE_DIR, or ValueError if it isn't set to an existing directory.
+
+    It isn't created here: a directory that doesn't exist yet is more
+    likely a disk that isn't mounted than one that should be made on the
+    instance's throwaway filesystem.
+    """
+    directory = Config.PARTITION_ARCHIVE_DIR
+    if not directory:
+        raise ValueError("PARTITION_EXPIRY=archive needs PARTITION_ARCHIVE_DIR set to a persistent disk")
+    if not os.path.isdir(directory):
+        raise ValueError(f"PARTITION_ARCHIVE_DIR {directory!r} is not a directory; is the disk mounted?")
+    return directory
+
+
+def archive_table(conn, name, directory):
+    """Write a detached partition to <directory>/<name>.csv.gz, then drop it.
+
+    The file is synced to disk before the table is dropped, and a table
+    that fails to archive is left in place for the next run.
+    """
+    path = os.path.join(directory, f"{name}.csv.gz")
+    partial = path + ".partial"
+    with conn.transaction():
+        with conn.cursor() as cursor:
+            with open(partial, "wb") as raw:
+                with gzip.GzipFile(fileobj=raw, mode="wb") as archive:
+                    with cursor.copy(f"COPY {name} TO STDOUT WITH (FORMAT csv, HEADER)") as copy:
+                        for data in copy:
+                            archive.write(data)
+                raw.flush()
+                os.fsync(raw.fileno())
+            os.replace(partial, path)
+            cursor.execute(f"DROP TABLE {name}")
+    return path
+
+
+def run_maintenance(today=None, upcoming_only=False, retire_legacy=False):
+    """Create upcoming partitions and retire expired ones.
+
+    upcoming_only skips the retiring; retire_legacy retires the legacy
+    partition now rather than once it is all past retention. Returns a
+    dict listing the partitions created, detached and archived. Raises
+    ValueError, before detaching anything, if archiving is on but has
+    nowhere safe to write.
+    """
+    today = today or datetime.date.today()
+    result = {"created": [], "detached": [], "archived": []}
+
+    with get_db_connection() as conn:
+        with conn.transaction():
+            with conn.cursor() as cursor:
+                _lock(cursor)
+                result["created"] = create_upcoming(cursor, today)
+
+        if upcoming_only or (Config.PARTITION_RETENTION_MONTHS <= 0 and not retire_legacy):
+            return result
+        directory = archive_dir() if Config.PARTITION_EXPIRY == "archive" else None
+
+        # Partitions ending on or before this date are past retention
+        if Config.PARTITION_RETENTION_MONTHS > 0:
+            cutoff = add_months(today.replace(day=1), -Config.PARTITION_RETENTION_MONTHS)
+        else:
+            cutoff = datetime.date.min
+        with conn.transaction():
+            with conn.cursor() as cursor:
+                _lock(cursor)
+                expired = expired_partitions(cursor, cutoff, retire_legacy)
+                result["detached"] = [name for name, attached in expired if attached]
+                detach_partitions(cursor, result["detached"])
+
+        if directory:
+            # One transaction per table, so a failure only holds that one back
+            for name, _ in expired:
+                result["archived"].append(archive_table(conn, name, directory))
+    return result
+
+
+def main(argv):
+    configure_logging()
+    try:
+        result = run_maintenance(upcoming_only="--upcoming" in argv, retire_legacy="--retire-legacy" in argv)
+    except ValueError as e:
+        logger.error("Partition maintenance stopped: %s", e)
+        return 1
+    for name in result["created"]:
+        print(f"Created partition {name}")
+    for name in result["detached"]:
+        print(f"Detached partition {name}")
+    for path in result["archived"]:
+        print(f"Archived to {path}")
+    if not any(result.values()):
+        print("message_logs partitions are up to date")
+    return 0
+
+
+if __name__ == "__main__":
+    # python -m database.partitions [--upcoming | --retire-legacy]
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,150 @@
+import logging
+import threading
+from contextlib import contextmanager
+
+from psycopg import Cursor
+from psycopg_pool import ConnectionPool, PoolTimeout
+from config import Config, DATABASE_CONFIG
+from metrics import timed_within
+
+logger = logging.getLogger(__name__)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+_query_count = 0
+_query_count_lock = threading.Lock()
+
+# Per thread, a list of after-commit callbacks for each open get_db_connection()
+_transactions = threading.local()
+
+
+class DatabaseUnavailable(Exception):
+    """Raised when no pooled connection could be acquired in time"""
+
+
+def _count_query():
+    global _query_count
+    with _query_count_lock:
+        _query_count += 1
+
+
+class CountingCursor(Cursor):
+    """Cursor that counts the statements it sends, i.e. database round trips.
+
+    The count shows up as "queries" in get_pool_stats(); the load-test
+    harness divides it by the messages sent.
+    """
+
+    def execute(self, *args, **kwargs):
+        _count_query()
+        return super().execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        _count_query()
+        return super().executemany(*args, **kwargs)
+
+    def copy(self, *args, **kwargs):
+        _count_query()
+        return super().copy(*args, **kwargs)
+
+
+def get_pool():
+    """Return the process-wide connection pool, opening it on first use"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                pool = ConnectionPool(
+                    kwargs={
+                        **DATABASE_CONFIG,
+                        # pgbouncer in transaction mode cannot share prepared statements
+                        "prepare_threshold": None,
+                        "cursor_factory": CountingCursor,
+                    },
+                    min_size=Config.DB_POOL_MIN_SIZE,
+                    max_size=Config.DB_POOL_MAX_SIZE,
+                    max_idle=Config.DB_POOL_MAX_IDLE,
+                    timeout=Config.DB_POOL_TIMEOUT,
+                    check=ConnectionPool.check_connection,
+                    name="whatsapp-chatbot",
+                    open=False,
+                )
+                # Don't block startup if the database is slow to come up
+                pool.open(wait=False)
+                _pool = pool
+    return _pool
+
+
+@contextmanager
+def get_db_connection():
+    """Borrow a connection from the pool.
+
+    The transaction is committed when the block exits cleanly and rolled
+    back on error, then the connection is returned to the pool. Callbacks
+    registered with after_commit() inside the block run after the commit.
+    """
+    stack = _transactions.__dict__.setdefault("stack", [])
+    callbacks = []
+    stack.append(callbacks)
+    try:
+        # Only counted on the message path
+        with timed_within("db"), get_pool().connection() as conn:
+            yield conn
+    except PoolTimeout as e:
+        logger.warning("Database connection error: %s", e)
+        raise DatabaseUnavailable(str(e)) from e
+    finally:
+        stack.pop()
+
+    for callback, args in callbacks:
+        try:
+            callback(*args)
+        except Exception as e:
+            logger.error("Error in after-commit callback: %s", e)
+
+
+def after_commit(callback, *args):
+    """Run callback(*args) once the enclosing get_db_connection() block commits.
+
+    Nothing runs if the block rolls back. Outside a block the callback
+    runs straight away.
+    """
+    stack = getattr(_transactions, "stack", None)
+    if stack:
+        stack[-1].append((callback, args))
+    else:
+        callback(*args)
+
+
+def get_pool_stats():
+    """Get connection pool statistics"""
+    if _pool is None:
+        return {}
+
+    stats = _pool.get_stats()
+    pool_size = stats.get("pool_size", 0)
+    pool_available = stats.get("pool_available", 0)
+    return {
+        "pool_min": stats.get("pool_min", Config.DB_POOL_MIN_SIZE),
+        "pool_max": stats.get("pool_max", Config.DB_POOL_MAX_SIZE),
+        "pool_size": pool_size,
+        "pool_available": pool_available,
+        "in_use": pool_size - pool_available,
+        "requests_waiting": stats.get("requests_waiting", 0),
+        "requests_num": stats.get("requests_num", 0),
+        "requests_queued": stats.get("requests_queued", 0),
+        "requests_wait_ms": stats.get("requests_wait_ms", 0),
+        "checkout_failures": stats.get("requests_errors", 0),
+        "connections_errors": stats.get("connections_errors", 0),
+        "queries": _query_count,
+    }
+
+
+def close_pool():
+    """Close the pool and all its connections"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
@@ -0,0 +1,92 @@
+import threading
+import time
+import zlib
+
+# Index range scan on last_seen; touches only the senders active in the window
+ACTIVE_USERS_SQL = """
+    SELECT COUNT(*)
+    FROM sender_activity
+    WHERE last_seen >= NOW() - INTERVAL '24 hours'
+"""
+
+PENDING_ACTIONS_COUNT_SQL = "SELECT COUNT(*) FROM pending_actions WHERE status = 'pending'"
+
+def record_log_stats(cursor, rows):
+    """Fold a batch of message_logs rows into the dashboard rollups.
+
+    Runs on the caller's cursor, in the same transaction as the insert,
+    so the counters never drift from message_logs.
+    """
+    if not rows:
+        return
+
+    success = sum(1 for row in rows if row[3])
+    cursor.execute("""
+        UPDATE message_counters
+        SET total_messages = total_messages + %s,
+            success_messages = success_messages + %s
+        WHERE id = 1
+    """, (len(rows), success))
+
+    # Sorted so concurrent flushes lock sender rows in the same order
+    senders = sorted({row[0] for row in rows})
+    cursor.execute("""
+        INSERT INTO sender_activity (sender, last_seen)
+        SELECT sender, NOW() FROM unnest(%s::text[]) AS sender
+        ON CONFLICT (sender) DO UPDATE SET last_seen = EXCLUDED.last_seen
+    """, (senders,))
+
+def read_dashboard_metrics(cursor):
+    """Read the dashboard metrics from the rollup tables"""
+    cursor.execute("SELECT total_messages, success_messages FROM message_counters WHERE id = 1")
+    row = cursor.fetchone()
+    total_messages, success_count = row if row else (0, 0)
+    success_rate = round((success_count / total_messages * 100), 1) if total_messages > 0 else 0
+
+    cursor.execute(ACTIVE_USERS_SQL)
+    active_users = cursor.fetchone()[0] or 0
+
+    cursor.execute(PENDING_ACTIONS_COUNT_SQL)
+    pending_actions = cursor.fetchone()[0] or 0
+
+    return {
+        'total_messages': total_messages,
+        'success_rate': success_rate,
+        'active_users': active_users,
+        'pending_actions': pending_actions
+    }
+
+
+class MetricsCache:
+    """Holds the last computed dashboard metrics for `ttl` seconds.
+
+    `version` is a checksum of the cached figures, which makes it a cheap
+    version token for them. Being derived from the values, it agrees
+    across worker processes and restarts, unlike a counter would.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.version = None
+        self._value = None
+        self._expires = 0
+        self._lock = threading.Lock()
+
+    def get(self, loader):
+        now = time.monotonic()
+        if self._value is not None and now < self._expires:
+            return self._value
+        with self._lock:
+            # Another thread may have refreshed it while we waited
+            if self._value is not None and time.monotonic() < self._expires:
+                return self._value
+            value = loader()
+            if value:
+                if value != self._value:
+                    self.version = f"{zlib.crc32(repr(sorted(value.items())).encode()):x}"
+                self._value = value
+                self._expires = time.monotonic() + self.ttl
+            return value
+
+    def invalidate(self):
+        self._expires = 0
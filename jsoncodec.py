@@ -0,0 +1,39 @@
+"""JSON encoding and decoding for the webhook, Graph API sends and dashboard API.
+
+Uses orjson when it is installed (pip install orjson) and the standard
+library otherwise. Both produce compact UTF-8 bytes, so callers don't
+need to care which one is in use.
+"""
+import datetime
+import decimal
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _default(obj):
+    if isinstance(obj, decimal.Decimal):
+        return float(obj)
+    if isinstance(obj, (datetime.datetime, datetime.date)):
+        return obj.isoformat()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+if orjson is not None:
+    BACKEND = "orjson"
+
+    def dumps(obj):
+        return orjson.dumps(obj, default=_default)
+
+    loads = orjson.loads
+else:
+    BACKEND = "json"
+
+    def dumps(obj):
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=_default).encode("utf-8")
+
+    def loads(data):
+        return json.loads(data)
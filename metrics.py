@@ -0,0 +1,92 @@
+"""Latency histograms for the message path, exposed in Prometheus text format.
+
+Stages recorded under chatbot_stage_seconds{stage=...}:
+
+- parse: extracting and de-duplicating the messages in a webhook
+- state: loading or saving a conversation Session
+- db: one pooled database transaction, checkout included, made while
+  handling a message (background log writes, the outbox and the
+  dashboard aren't counted)
+- reply: building the reply (includes the state and db work it does)
+- send: handing a payload to the Graph API, retries and rate limiting included
+- total: one inbound message, from handling start to reply sent
+
+Histograms are per process; under gunicorn each worker serves its own.
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    """Cumulative-bucket histogram with one series per label value"""
+
+    def __init__(self, name, help_text, label, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_value, seconds):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                # One count per bucket plus +Inf, then the sum
+                series = self._series[label_value] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += seconds
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = {value: list(series) for value, series in self._series.items()}
+        for value, series in sorted(snapshot.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{self.label}="{value}",le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{{self.label}="{value}"}} {series[-1]:.6f}')
+            lines.append(f'{self.name}_count{{{self.label}="{value}"}} {cumulative}')
+        return lines
+
+
+STAGE_SECONDS = Histogram("chatbot_stage_seconds", "Time spent per message-path stage", "stage")
+
+# How many timed() stages this thread is inside
+_nesting = threading.local()
+
+
+@contextmanager
+def timed(stage):
+    """Record how long the block takes under `stage`, even if it raises"""
+    _nesting.depth = getattr(_nesting, "depth", 0) + 1
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(stage, time.perf_counter() - start)
+        _nesting.depth -= 1
+
+
+@contextmanager
+def timed_within(stage):
+    """timed(), but only inside another stage on this thread.
+
+    For shared code such as the database pool, which the message path
+    uses along with everything else.
+    """
+    if getattr(_nesting, "depth", 0):
+        with timed(stage):
+            yield
+    else:
+        yield
+
+
+def render_metrics():
+    return "\n".join(STAGE_SECONDS.render()) + "\n"
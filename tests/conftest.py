@@ -0,0 +1,18 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# .env ships blank values for these, which config.py can't parse;
+# load_dotenv() leaves variables that are already set alone
+os.environ.setdefault("DB_PORT", "5432")
+os.environ.setdefault("FLASK_PORT", "5000")
+
+
+@pytest.fixture
+def api():
+    """Test client for the Flask app"""
+    from app import app
+    return app.test_client()
@@ -0,0 +1,84 @@
+import gzip
+
+import pytest
+
+import app as app_module
+from config import Config
+
+ACTIONS = [{"id": n, "action_type": "phone_change", "sender": "254700000001", "details": {"note": "x" * 40},
+            "created_at": "2024-06-01 12:00:00"} for n in range(50)]
+
+
+@pytest.fixture
+def pending(monkeypatch):
+    """Serve ACTIONS at a version the test can change"""
+    state = {"version": "50-49-1225", "loads": 0}
+
+    def get_pending_actions(as_dicts=False):
+        state["loads"] += 1
+        return ACTIONS
+    monkeypatch.setattr(app_module, "get_pending_actions_version", lambda: state["version"])
+    monkeypatch.setattr(app_module, "get_pending_actions", get_pending_actions)
+    return state
+
+
+def test_matching_etag_gets_304_without_loading(api, pending):
+    first = api.get("/api/pending-actions")
+    assert first.status_code == 200
+    etag = first.headers["ETag"]
+    assert etag.startswith('W/"pending-actions-50-49-1225-')
+    assert first.headers["Cache-Control"] == "no-cache"
+
+    again = api.get("/api/pending-actions", headers={"If-None-Match": etag})
+    assert again.status_code == 304
+    assert again.get_data() == b""
+    assert again.headers["ETag"] == etag
+    assert pending["loads"] == 1
+
+
+def test_etag_changes_with_version_and_query(api, pending):
+    etag = api.get("/api/pending-actions").headers["ETag"]
+    assert api.get("/api/pending-actions?x=1").headers["ETag"] != etag
+
+    pending["version"] = "49-49-1176"
+    changed = api.get("/api/pending-actions", headers={"If-None-Match": etag})
+    assert changed.status_code == 200
+    assert changed.headers["ETag"] != etag
+
+
+def test_no_etag_when_version_unknown(api, pending):
+    pending["version"] = None
+    response = api.get("/api/pending-actions", headers={"If-None-Match": "*"})
+    assert response.status_code == 200
+    assert "ETag" not in response.headers
+
+
+def test_large_json_is_gzipped_for_clients_that_accept_it(api, pending):
+    plain = api.get("/api/pending-actions")
+    assert "Content-Encoding" not in plain.headers
+    assert "Accept-Encoding" in plain.headers["Vary"]
+
+    zipped = api.get("/api/pending-actions", headers={"Accept-Encoding": "gzip, deflate"})
+    assert zipped.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in zipped.headers["Vary"]
+    assert gzip.decompress(zipped.get_data()) == plain.get_data()
+    # Weak, so the same tag covers both encodings
+    assert zipped.headers["ETag"] == plain.headers["ETag"]
+
+
+def test_small_bodies_still_vary(api, monkeypatch):
+    monkeypatch.setattr(app_module, "get_pool_stats", lambda: {"size": 1})
+    response = api.get("/api/pool-stats", headers={"Accept-Encoding": "gzip"})
+    assert len(response.get_data()) < Config.GZIP_MIN_BYTES
+    assert "Content-Encoding" not in response.headers
+    assert "Accept-Encoding" in response.headers["Vary"]
+
+
+def test_gzip_refused_and_304s_left_alone(api, pending):
+    refused = api.get("/api/pending-actions", headers={"Accept-Encoding": "gzip;q=0"})
+    assert "Content-Encoding" not in refused.headers
+
+    etag = refused.headers["ETag"]
+    cached = api.get("/api/pending-actions", headers={"Accept-Encoding": "gzip", "If-None-Match": etag})
+    assert cached.status_code == 304
+    assert "Content-Encoding" not in cached.headers
@@ -0,0 +1,54 @@
+from contextlib import contextmanager
+
+import pytest
+
+from config import Config
+from database import events, pool
+from database.events import EventBroker, announce
+from database.pool import get_db_connection
+
+
+class FakePool:
+    def __init__(self):
+        self.log = []
+
+    @contextmanager
+    def connection(self):
+        try:
+            yield self
+        except Exception:
+            self.log.append("rollback")
+            raise
+        self.log.append("commit")
+
+
+@pytest.fixture
+def subscription(monkeypatch):
+    monkeypatch.setattr(Config, "DASHBOARD_EVENTS", "local")
+    monkeypatch.setattr(pool, "_pool", FakePool())
+    broker = EventBroker()
+    monkeypatch.setattr(events, "_broker", broker)
+    return broker.subscribe()
+
+
+def test_local_events_wait_for_commit(subscription):
+    with get_db_connection() as conn:
+        announce(None, "pending_action", {"id": 1})
+        assert subscription.empty()
+        assert conn.log == []
+    assert conn.log == ["commit"]
+    assert subscription.get_nowait() == ("pending_action", {"id": 1})
+
+
+def test_local_events_dropped_on_rollback(subscription):
+    with pytest.raises(RuntimeError):
+        with get_db_connection():
+            announce(None, "pending_action", {"id": 1})
+            raise RuntimeError("insert failed")
+    assert subscription.empty()
+
+    # The failed block's events don't leak into the next one
+    with get_db_connection():
+        announce(None, "pending_action", {"id": 2})
+    assert subscription.get_nowait() == ("pending_action", {"id": 2})
+    assert subscription.empty()
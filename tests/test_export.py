@@ -0,0 +1,118 @@
+import csv
+import datetime
+import decimal
+import io
+import json
+
+import pytest
+
+import app as app_module
+from database import export
+from database.export import csv_chunks, export_chunks, ndjson_chunks
+
+COLUMNS = ("id", "sender", "message", "details", "timestamp")
+
+ROWS = [
+    (1, "254700000001", 'Line one\nline "two", with a comma', {"child_id": 11, "note": "ñ"},
+     datetime.datetime(2024, 6, 1, 12, 30)),
+    (2, "254700000002", "Habari 👋", None, datetime.datetime(2024, 6, 1, 12, 31)),
+    (3, "254700000003", "", [1, 2], datetime.datetime(2024, 6, 1, 12, 32)),
+]
+
+
+class FakeExport:
+    columns = COLUMNS
+    table = "message_logs"
+
+    def __init__(self, rows, fail_after=None):
+        self._rows = rows
+        self.fail_after = fail_after
+
+    def rows(self):
+        for n, row in enumerate(self._rows):
+            if n == self.fail_after:
+                raise RuntimeError("connection lost")
+            yield row
+
+
+@pytest.fixture
+def two_per_chunk(monkeypatch):
+    monkeypatch.setattr(export, "ROWS_PER_CHUNK", 2)
+
+
+def test_ndjson_chunks_hold_whole_lines(two_per_chunk):
+    chunks = list(ndjson_chunks(COLUMNS, ROWS))
+    assert len(chunks) == 2
+    assert all(chunk.endswith(b"\n") for chunk in chunks)
+
+    lines = b"".join(chunks).decode("utf-8").splitlines()
+    assert [json.loads(line) for line in lines] == [
+        {"id": 1, "sender": "254700000001", "message": 'Line one\nline "two", with a comma',
+         "details": {"child_id": 11, "note": "ñ"}, "timestamp": "2024-06-01T12:30:00"},
+        {"id": 2, "sender": "254700000002", "message": "Habari 👋", "details": None,
+         "timestamp": "2024-06-01T12:31:00"},
+        {"id": 3, "sender": "254700000003", "message": "", "details": [1, 2],
+         "timestamp": "2024-06-01T12:32:00"},
+    ]
+
+
+def test_ndjson_encodes_decimals():
+    [chunk] = ndjson_chunks(("balance",), [(decimal.Decimal("12.50"),)])
+    assert json.loads(chunk) == {"balance": 12.5}
+
+
+def test_csv_chunks_quote_and_keep_json_columns(two_per_chunk):
+    chunks = list(csv_chunks(COLUMNS, ROWS))
+    # Header plus two rows, then the last row
+    assert len(chunks) == 2
+
+    rows = list(csv.reader(io.StringIO(b"".join(chunks).decode("utf-8"))))
+    assert rows[0] == list(COLUMNS)
+    assert rows[1] == ["1", "254700000001", 'Line one\nline "two", with a comma',
+                       '{"child_id":11,"note":"ñ"}', "2024-06-01 12:30:00"]
+    assert rows[2] == ["2", "254700000002", "Habari 👋", "", "2024-06-01 12:31:00"]
+    assert rows[3] == ["3", "254700000003", "", "[1,2]", "2024-06-01 12:32:00"]
+
+
+def test_empty_exports():
+    assert list(ndjson_chunks(COLUMNS, [])) == []
+    assert list(csv_chunks(COLUMNS, [])) == [b"id,sender,message,details,timestamp\r\n"]
+
+
+def test_error_mid_stream_truncates_the_output(two_per_chunk):
+    chunks = list(export_chunks(FakeExport(ROWS, fail_after=2), "ndjson"))
+    assert len(chunks) == 1
+    assert len(chunks[0].splitlines()) == 2
+
+
+@pytest.mark.parametrize("path, status", [
+    ("/api/export/secrets", 404),
+    ("/api/export/messages?format=xml", 400),
+    ("/api/export/messages?since=soon", 400),
+])
+def test_bad_export_requests_never_open_a_connection(api, monkeypatch, path, status):
+    monkeypatch.setattr(app_module, "open_export", lambda *args: pytest.fail("export opened"))
+    assert api.get(path).status_code == status
+
+
+def test_export_response_streams_and_closes(api, monkeypatch, two_per_chunk):
+    closed = []
+    fake = FakeExport(ROWS)
+    fake.close = lambda: closed.append(True)
+    monkeypatch.setattr(app_module, "open_export", lambda name, since, until: fake)
+
+    response = api.get("/api/export/messages?format=csv")
+    assert response.status_code == 200
+    assert response.mimetype == "text/csv"
+    assert response.headers["Content-Disposition"].startswith('attachment; filename="messages-')
+    # Streamed bodies are left alone by the gzip hook
+    assert "Content-Encoding" not in response.headers
+    assert len(list(csv.reader(io.StringIO(response.get_data(as_text=True))))) == 1 + len(ROWS)
+    response.close()
+    assert closed == [True]
+
+
+def test_export_busy(api, monkeypatch):
+    monkeypatch.setattr(app_module, "open_export", lambda *args: None)
+    response = api.get("/api/export/pending-actions")
+    assert response.status_code == 503
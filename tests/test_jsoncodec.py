@@ -0,0 +1,54 @@
+import datetime
+import decimal
+import importlib.util
+import sys
+
+import pytest
+
+import jsoncodec
+
+SAMPLES = [
+    {"messaging_product": "whatsapp", "to": "254700000001", "type": "text",
+     "text": {"body": "💰 Balance: Ksh 1,250\n\"quoted\" ñ"}},
+    [1, -2, 3.5, 0.1, True, False, None, "", [], {}],
+    {"amount": decimal.Decimal("12.50"), "when": datetime.datetime(2024, 6, 1, 12, 30, 5, 120000),
+     "day": datetime.date(2024, 6, 1),
+     "utc": datetime.datetime(2024, 6, 1, 12, 30, tzinfo=datetime.timezone.utc)},
+    "</script> ",
+]
+
+
+def load_codec(monkeypatch, with_orjson):
+    """A fresh copy of jsoncodec, with or without orjson importable"""
+    if not with_orjson:
+        monkeypatch.setitem(sys.modules, "orjson", None)
+    spec = importlib.util.spec_from_file_location(f"jsoncodec_{with_orjson}", jsoncodec.__file__)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def codecs(monkeypatch):
+    pytest.importorskip("orjson")
+    fast = load_codec(monkeypatch, True)
+    stdlib = load_codec(monkeypatch, False)
+    assert (fast.BACKEND, stdlib.BACKEND) == ("orjson", "json")
+    return fast, stdlib
+
+
+@pytest.mark.parametrize("obj", SAMPLES)
+def test_backends_encode_identically(codecs, obj):
+    fast, stdlib = codecs
+    encoded = stdlib.dumps(obj)
+    assert isinstance(encoded, bytes)
+    assert fast.dumps(obj) == encoded
+    assert fast.loads(encoded) == stdlib.loads(encoded)
+
+
+def test_both_reject_bad_input_with_value_error(codecs):
+    for codec in codecs:
+        with pytest.raises(ValueError):
+            codec.loads(b'{"entry": [')
+        with pytest.raises(TypeError):
+            codec.dumps({"x": object()})
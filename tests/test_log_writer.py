@@ -0,0 +1,47 @@
+import threading
+
+import pytest
+
+from database import log_writer
+from database.log_writer import LogWriter
+from whatsapp.workers import WorkerPool
+
+
+def row(n):
+    return ("254700000001", f"message {n}", "reply", True, None, None)
+
+
+@pytest.fixture
+def copied(monkeypatch):
+    batches = []
+    monkeypatch.setattr(log_writer, "copy_message_logs", lambda batch: batches.append(list(batch)))
+    return batches
+
+
+def test_stop_flushes_buffered_rows(copied):
+    writer = LogWriter(batch_size=100, flush_interval=60)
+    writer.write_many([row(n) for n in range(5)])
+    writer.stop(5)
+    assert sum(len(batch) for batch in copied) == 5
+
+
+def test_writes_after_stop_are_synchronous(copied):
+    writer = LogWriter(batch_size=100, flush_interval=60)
+    writer.stop(5)
+    assert writer.write(row(1))
+    assert copied == [[row(1)]]
+    assert writer._thread is None
+
+
+def test_pool_drained_after_writer_stop_loses_nothing(copied):
+    writer = LogWriter(batch_size=100, flush_interval=60)
+    pool = WorkerPool(1, 10)
+    release = threading.Event()
+    pool.submit(release.wait, 5)
+    for n in range(5):
+        pool.submit(writer.write, row(n), key="254700000001")
+
+    writer.stop(5)
+    release.set()
+    pool.shutdown(timeout=5)
+    assert sorted(r[1] for batch in copied for r in batch) == [f"message {n}" for n in range(5)]
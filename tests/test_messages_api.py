@@ -0,0 +1,73 @@
+import base64
+import datetime
+
+import pytest
+
+import app as app_module
+from config import Config
+from database.models import decode_message_cursor, encode_message_cursor
+
+
+@pytest.fixture
+def pages(monkeypatch):
+    """Records get_message_page calls; the version lookup must not run for a 400"""
+    calls = []
+    monkeypatch.setattr(app_module, "get_messages_version", lambda: calls.append("version") or "1.10")
+
+    def get_message_page(limit, **page):
+        calls.append((limit, page))
+        return [], None
+    monkeypatch.setattr(app_module, "get_message_page", get_message_page)
+    return calls
+
+
+def test_cursor_round_trip():
+    for timestamp in (datetime.datetime(2024, 6, 1, 12, 30, 5, 123456), datetime.datetime(2024, 6, 1)):
+        assert decode_message_cursor(encode_message_cursor(timestamp, 4711)) == (timestamp, 4711)
+
+
+@pytest.mark.parametrize("token", [
+    "not base64!",
+    base64.urlsafe_b64encode(b"2024-06-01T12:00:00").decode(),
+    base64.urlsafe_b64encode(b"2024-06-01T12:00:00|abc").decode(),
+    base64.urlsafe_b64encode(b"yesterday|12").decode(),
+    base64.urlsafe_b64encode(b"\xff\xfe|12").decode(),
+    "é",
+])
+def test_bad_cursor_raises_value_error(token):
+    with pytest.raises(ValueError):
+        decode_message_cursor(token)
+
+
+@pytest.mark.parametrize("query, error", [
+    ("limit=ten", "limit must be a whole number"),
+    ("success=maybe", "success must be true or false"),
+    ("since=yesterday", "since must be an ISO 8601 time"),
+    ("until=2024-13-01", "until must be an ISO 8601 time"),
+    ("cursor=bogus", "Invalid cursor"),
+])
+def test_bad_parameters_are_rejected_before_any_query(api, pages, query, error):
+    response = api.get(f"/api/messages?{query}")
+    assert response.status_code == 400
+    assert error in response.get_json()["error"]
+    assert pages == []
+
+
+def test_parameters_are_parsed(api, pages):
+    cursor = encode_message_cursor(datetime.datetime(2024, 6, 1, 12), 99)
+    response = api.get(f"/api/messages?limit=5000&cursor={cursor}&sender=2547&success=FALSE"
+                       "&since=2024-06-01T00:00:00Z&until=2024-07-01")
+    assert response.status_code == 200
+    assert pages == ["version", (Config.MESSAGES_PAGE_MAX, {
+        "cursor": (datetime.datetime(2024, 6, 1, 12), 99),
+        "sender": "2547",
+        "success": False,
+        "since": datetime.datetime(2024, 6, 1, tzinfo=datetime.timezone.utc),
+        "until": datetime.datetime(2024, 7, 1),
+    })]
+
+
+def test_limit_is_clamped_and_defaults(api, pages):
+    api.get("/api/messages?limit=0")
+    api.get("/api/messages")
+    assert [call[0] for call in pages if call != "version"] == [1, Config.MESSAGES_PAGE_SIZE]
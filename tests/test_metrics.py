@@ -0,0 +1,28 @@
+from metrics import STAGE_SECONDS, timed, timed_within
+
+
+def count(stage):
+    series = STAGE_SECONDS._series.get(stage)
+    return sum(series[:-1]) if series else 0
+
+
+def test_timed_within_only_counts_inside_another_stage():
+    before = count("db-test")
+    with timed_within("db-test"):
+        pass
+    assert count("db-test") == before
+
+    with timed("total-test"):
+        with timed_within("db-test"):
+            pass
+    assert count("db-test") == before + 1
+
+    # A stage that raised still unwinds
+    try:
+        with timed("total-test"):
+            raise RuntimeError
+    except RuntimeError:
+        pass
+    with timed_within("db-test"):
+        pass
+    assert count("db-test") == before + 1
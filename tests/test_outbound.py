@@ -0,0 +1,101 @@
+import time
+
+import pytest
+import requests
+
+from whatsapp import handler
+from whatsapp.outbound import GraphAPIError, OutboundDispatcher, TokenBucket, classify_error
+from whatsapp.workers import WorkerPool
+
+
+def http_error(status, body):
+    response = requests.models.Response()
+    response.status_code = status
+    response._content = body.encode("utf-8")
+    return requests.exceptions.HTTPError(f"{status} error", response=response)
+
+
+def test_classify_error_reads_graph_error():
+    error = classify_error(http_error(400, '{"error": {"code": 131056, "message": "Pair rate limit"}}'))
+    assert error.code == 131056
+    assert str(error) == "Pair rate limit"
+    assert error.retryable
+
+
+def test_classify_error_tolerates_unexpected_json():
+    for body in ('[1, 2]', '{"error": "Bad gateway"}', '"oops"', 'not json', '{"error": null}'):
+        error = classify_error(http_error(502, body))
+        assert error.status == 502
+        assert error.code is None
+        assert error.retryable
+
+    error = classify_error(http_error(400, '{"error": "Invalid parameter"}'))
+    assert str(error) == "Invalid parameter"
+    assert not error.retryable
+
+
+def test_zero_rate_bucket_is_unlimited():
+    bucket = TokenBucket(0, 0)
+    assert all(bucket.acquire(timeout=0) for _ in range(100))
+
+
+def test_bucket_limits_to_capacity():
+    bucket = TokenBucket(1, 2)
+    assert bucket.acquire(timeout=0)
+    assert bucket.acquire(timeout=0)
+    assert not bucket.acquire(timeout=0)
+
+
+class FlakyClient:
+    timeout = (1, 1)
+
+    def __init__(self, failures):
+        self.failures = failures
+        self.calls = 0
+
+    def post_message(self, payload):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise http_error(503, '{"error": {"code": 131016, "message": "Service unavailable"}}')
+        return {"messages": [{"id": "wamid.1"}]}
+
+
+def dispatcher(client, rate=100, burst=10):
+    return OutboundDispatcher(client, rate=rate, burst=burst, recipient_rate=100, recipient_burst=10,
+                              max_retries=3, backoff_base=0.2, acquire_timeout=5)
+
+
+def test_no_wait_send_fails_fast_instead_of_backing_off():
+    client = FlakyClient(failures=1)
+    started = time.monotonic()
+    with pytest.raises(GraphAPIError) as raised:
+        dispatcher(client).send("254700000001", {}, wait=False)
+    assert raised.value.retryable
+    assert client.calls == 1
+    assert time.monotonic() - started < 0.1
+
+
+def test_no_wait_send_fails_fast_when_rate_limited():
+    outbound = dispatcher(FlakyClient(failures=0), rate=0.1, burst=1)
+    outbound.send("254700000001", {}, wait=False)
+    started = time.monotonic()
+    with pytest.raises(GraphAPIError) as raised:
+        outbound.send("254700000002", {}, wait=False)
+    assert raised.value.retryable
+    assert time.monotonic() - started < 0.1
+
+
+def test_request_thread_hands_a_throttled_send_to_the_pool(monkeypatch):
+    client = FlakyClient(failures=1)
+    pool = WorkerPool(1, 10)
+    logged = []
+    monkeypatch.setattr(handler, "get_dispatcher", lambda: dispatcher(client))
+    monkeypatch.setattr(handler, "get_webhook_pool", lambda: pool)
+    monkeypatch.setattr(handler, "log_message", lambda *args, **kwargs: logged.append(kwargs["success"]))
+
+    # Called on the test's own thread, like a sync-mode webhook request
+    assert handler.send_payload("254700000001", {}, "Hello")
+    pool.shutdown(timeout=5)
+
+    assert client.calls == 2
+    assert logged == [True]
@@ -0,0 +1,73 @@
+import pytest
+
+from whatsapp import outbox
+from whatsapp.outbound import GraphAPIError
+from whatsapp.outbox import OutboxDrainer
+
+
+class FakeDispatcher:
+    def __init__(self, attempt_seconds=10, fail=None, clock=None):
+        self.attempt_seconds = attempt_seconds
+        self.fail = fail or {}
+        self.clock = clock
+        self.sent = []
+        self.retries = []
+
+    def max_attempt_seconds(self):
+        return self.attempt_seconds
+
+    def send(self, recipient, payload, max_retries=None):
+        self.retries.append(max_retries)
+        if self.clock is not None:
+            self.clock.now += self.clock.step
+        if recipient in self.fail:
+            raise self.fail[recipient]
+        self.sent.append(recipient)
+
+
+class FakeClock:
+    def __init__(self, step):
+        self.now = 0.0
+        self.step = step
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def outbox_calls(monkeypatch):
+    calls = {}
+    rows = [(n, f"2547{n:08d}", {"n": n}, f"body {n}", 1) for n in range(1, 6)]
+    monkeypatch.setattr(outbox, "claim_outbox_batch", lambda limit, lease: rows[:limit])
+    monkeypatch.setattr(outbox, "complete_outbox", lambda *args: calls.setdefault("complete", args))
+    monkeypatch.setattr(outbox, "log_messages", lambda rows: calls.setdefault("log", rows))
+    return calls
+
+
+def test_sends_are_single_attempts(outbox_calls):
+    error = GraphAPIError("throttled", status=429, retryable=True)
+    dispatcher = FakeDispatcher(fail={"254700000002": error})
+    OutboxDrainer(dispatcher, batch_size=5).drain_once()
+
+    assert set(dispatcher.retries) == {0}
+    sent_ids, retry_rows, failed_rows, released_ids = outbox_calls["complete"]
+    assert sent_ids == [1, 3, 4, 5]
+    assert [row[2] for row in retry_rows] == [2]
+    assert failed_rows == [] and released_ids == []
+
+
+def test_rows_past_the_lease_window_are_released(outbox_calls, monkeypatch):
+    clock = FakeClock(step=20)
+    monkeypatch.setattr(outbox.time, "monotonic", clock.monotonic)
+    dispatcher = FakeDispatcher(attempt_seconds=10, clock=clock)
+    # 60s lease - 5s margin - 10s attempt leaves 45s to start sends in
+    OutboxDrainer(dispatcher, batch_size=5, lease_seconds=60).drain_once()
+
+    sent_ids, retry_rows, failed_rows, released_ids = outbox_calls["complete"]
+    assert sent_ids == [1, 2, 3]
+    assert released_ids == [4, 5]
+
+
+def test_lease_must_fit_one_attempt():
+    with pytest.raises(ValueError):
+        OutboxDrainer(FakeDispatcher(attempt_seconds=58), lease_seconds=60)
@@ -0,0 +1,109 @@
+import pytest
+
+from whatsapp import message_processor
+from whatsapp.dedup import MessageDeduplicator
+from whatsapp.message_processor import schedule_messages
+
+
+class FakePool:
+    def __init__(self, accept=True):
+        self.accept = accept
+        self.jobs = []
+
+    def submit(self, fn, *args, key=None):
+        if self.accept:
+            self.jobs.append((fn, args, key))
+        return self.accept
+
+    def run(self):
+        for fn, args, _ in self.jobs:
+            fn(*args)
+
+
+class SharedStore(MessageDeduplicator):
+    """Stands in for the processed_messages table; records who asked it"""
+
+    def __init__(self, claimed=()):
+        super().__init__(100)
+        self.claimed = set(claimed)
+        self.calls = []
+
+    def claim(self, message_ids):
+        self.calls.append(list(message_ids))
+        fresh = [message_id for message_id in message_ids if message_id not in self.claimed]
+        self.claimed.update(fresh)
+        return fresh
+
+
+def payload(*messages):
+    return {"entry": [{"changes": [{"value": {"messages": list(messages)}}]}]}
+
+
+def text(message_id, sender="254700000001", body="hi"):
+    return {"from": sender, "id": message_id, "type": "text", "text": {"body": body}}
+
+
+@pytest.fixture
+def logged(monkeypatch):
+    logged = []
+    monkeypatch.setattr(message_processor, "log_messages", lambda rows: logged.extend(row[2] for row in rows))
+    return logged
+
+
+@pytest.fixture
+def handled(monkeypatch, logged):
+    handled = []
+
+    def handle(msg):
+        handled.append(msg["id"])
+        logged.append(f"reply to {msg['id']}")
+    monkeypatch.setattr(message_processor, "handle_message", handle)
+    return handled
+
+
+def test_shared_dedup_waits_for_the_worker(monkeypatch, handled):
+    # wamid.2 was already handled by another node
+    store = SharedStore(claimed={"wamid.2"})
+    monkeypatch.setattr(message_processor, "deduplicator", store)
+    pool = FakePool()
+
+    assert schedule_messages(payload(text("wamid.1"), text("wamid.2"), text("wamid.1")), pool)
+    assert store.calls == []
+
+    pool.run()
+    assert handled == ["wamid.1"]
+    assert store.calls == [["wamid.1"], ["wamid.2"]]
+
+
+def test_rejected_messages_are_forgotten_locally(monkeypatch, handled):
+    store = SharedStore()
+    monkeypatch.setattr(message_processor, "deduplicator", store)
+
+    assert not schedule_messages(payload(text("wamid.1")), FakePool(accept=False))
+    pool = FakePool()
+    assert schedule_messages(payload(text("wamid.1")), pool)
+    pool.run()
+    assert handled == ["wamid.1"]
+
+
+def test_malformed_messages_are_skipped(monkeypatch, handled):
+    monkeypatch.setattr(message_processor, "deduplicator", SharedStore())
+    pool = FakePool()
+
+    assert schedule_messages(payload({"id": "wamid.1"}, "junk", text("wamid.2")), pool)
+    pool.run()
+    assert handled == ["wamid.2"]
+
+
+def test_processing_row_is_logged_before_the_reply(monkeypatch, handled, logged):
+    monkeypatch.setattr(message_processor, "deduplicator", SharedStore(claimed={"wamid.2"}))
+    pool = FakePool()
+    data = payload(text("wamid.1"), text("wamid.2"))
+    data["entry"][0]["changes"][0]["value"]["statuses"] = [{"status": "failed", "recipient_id": "254700000001"}]
+
+    assert schedule_messages(data, pool)
+    # Each message's log row goes with the message, under its sender's key
+    assert [key for _, _, key in pool.jobs] == ["254700000001", "254700000001", None]
+
+    pool.run()
+    assert logged == ["Processing", "reply to wamid.1", "Failed to deliver"]
@@ -0,0 +1,102 @@
+import random
+import threading
+import time
+
+from whatsapp.workers import WorkerPool
+
+
+def test_jobs_for_one_key_run_in_order():
+    pool = WorkerPool(4, 100)
+    done = []
+
+    def job(n):
+        time.sleep(random.uniform(0, 0.005))
+        done.append(n)
+
+    for n in range(30):
+        assert pool.submit(job, n, key="254700000001")
+    pool.shutdown(timeout=5)
+    assert done == list(range(30))
+
+
+def test_jobs_for_one_key_never_overlap():
+    pool = WorkerPool(4, 100)
+    running = []
+    overlaps = []
+
+    def job():
+        running.append(1)
+        if len(running) > 1:
+            overlaps.append(len(running))
+        time.sleep(0.002)
+        running.pop()
+
+    for _ in range(20):
+        pool.submit(job, key="same")
+    pool.shutdown(timeout=5)
+    assert overlaps == []
+
+
+def test_slow_key_does_not_block_other_keys():
+    pool = WorkerPool(2, 100)
+    release = threading.Event()
+    done = []
+
+    pool.submit(release.wait, 5, key="slow")
+    pool.submit(done.append, "slow-2", key="slow")
+    # Enough keys that a fixed key->worker mapping would put some behind "slow"
+    for n in range(20):
+        pool.submit(done.append, n, key=f"sender-{n}")
+
+    deadline = time.monotonic() + 2
+    while len(done) < 20 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert sorted(done) == list(range(20))
+
+    release.set()
+    pool.shutdown(timeout=5)
+    assert done[-1] == "slow-2"
+
+
+def test_submit_rejects_when_full():
+    pool = WorkerPool(1, 2)
+    release = threading.Event()
+    assert pool.submit(release.wait, 5, key="a")
+    time.sleep(0.05)  # let the worker pick up the first job
+    assert pool.submit(lambda: None, key="a")
+    assert pool.submit(lambda: None, key="b")
+    assert not pool.submit(lambda: None, key="c")
+    release.set()
+    pool.shutdown(timeout=5)
+
+
+def test_shutdown_drains_queued_jobs():
+    pool = WorkerPool(2, 100)
+    done = []
+    for n in range(10):
+        pool.submit(done.append, n, key=n % 3)
+    pool.shutdown(timeout=5)
+    assert sorted(done) == list(range(10))
+    assert not pool.submit(done.append, 99)
+
+
+def test_stats_name_the_keys_with_the_oldest_backlog():
+    pool = WorkerPool(1, 100)
+    release = threading.Event()
+    pool.submit(release.wait, 5, key="slow")
+    time.sleep(0.05)  # "slow" is running now; everything below waits
+    pool.submit(lambda: None, key="slow")
+    pool.submit(lambda: None, key="slow")
+    pool.submit(lambda: None, key="other")
+    pool.submit(lambda: None)
+
+    stats = pool.stats(top_keys=2)
+    release.set()
+    pool.shutdown(timeout=5)
+
+    first, second = stats["backlog"]
+    assert (first["key"], first["depth"]) == ("slow", 2)
+    assert first["running_ms"] >= 40
+    assert (second["key"], second["depth"], second["running_ms"]) == ("other", 1, None)
+    assert first["oldest_age_ms"] >= second["oldest_age_ms"]
+    assert pool.stats()["backlog"] == []
@@ -0,0 +1,69 @@
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from config import Config, WHATSAPP_CONFIG
+from jsoncodec import dumps
+
+
+class GraphClient:
+    """Long-lived Graph API client with a pooled keep-alive session.
+
+    The messages URL and auth headers are built once. The underlying
+    connection pool is shared by all threads, so concurrent sends reuse
+    warm TLS connections to graph.facebook.com instead of opening new ones.
+    """
+
+    def __init__(self, access_token, phone_number_id, api_version="v19.0",
+                 pool_size=10, connect_timeout=3.05, read_timeout=10,
+                 base_url="https://graph.facebook.com"):
+        self.messages_url = f"{base_url}/{api_version}/{phone_number_id}/messages"
+        self.headers = {
+            "Authorization": f"Bearer {access_token}",
+            "Content-Type": "application/json"
+        }
+        self.timeout = (connect_timeout, read_timeout)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=False)
+        self.session.mount(base_url, adapter)
+
+    def post_message(self, payload):
+        """POST a message payload and return the response, raising on HTTP errors.
+
+        `payload` is a dict, or JSON bytes that are sent as they are.
+        """
+        if not isinstance(payload, (bytes, bytearray)):
+            payload = dumps(payload)
+        response = self.session.post(
+            self.messages_url,
+            headers=self.headers,
+            data=payload,
+            timeout=self.timeout
+        )
+        response.raise_for_status()
+        return response
+
+    def close(self):
+        self.session.close()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_graph_client():
+    """Return the process-wide Graph API client"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = GraphClient(
+                    WHATSAPP_CONFIG["access_token"],
+                    WHATSAPP_CONFIG["phone_number_id"],
+                    api_version=Config.GRAPH_API_VERSION,
+                    pool_size=Config.GRAPH_POOL_SIZE,
+                    connect_timeout=Config.GRAPH_CONNECT_TIMEOUT,
+                    read_timeout=Config.GRAPH_READ_TIMEOUT,
+                    base_url=Config.GRAPH_API_URL,
+                )
+    return _client
@@ -0,0 +1,122 @@
+import logging
+import random
+import threading
+from collections import OrderedDict
+from config import Config
+from database.pool import get_db_connection, DatabaseUnavailable
+
+logger = logging.getLogger(__name__)
+
+
+class MessageDeduplicator:
+    """Remembers the WhatsApp message ids already accepted by this process.
+
+    Bounded LRU, so memory stays flat; Meta redelivers within minutes, so
+    the last `max_entries` ids are plenty to catch retries.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+        self.duplicates = 0
+
+    def filter_new(self, message_ids):
+        """Mark ids as seen and return the ones that weren't already"""
+        return self.claim(self.filter_local(message_ids))
+
+    def filter_local(self, message_ids):
+        """filter_new() against this process's memory only; never blocks on I/O"""
+        fresh = []
+        with self._lock:
+            for message_id in message_ids:
+                if message_id in self._seen:
+                    self._seen.move_to_end(message_id)
+                    self.duplicates += 1
+                    continue
+                self._seen[message_id] = True
+                fresh.append(message_id)
+            while len(self._seen) > self.max_entries:
+                self._seen.popitem(last=False)
+        return fresh
+
+    def claim(self, message_ids):
+        """Settle ids that passed filter_local(); in-process there's nothing left to check"""
+        return list(message_ids)
+
+    def forget(self, message_ids):
+        """Unmark ids that were accepted but could not be processed"""
+        self.forget_local(message_ids)
+
+    def forget_local(self, message_ids):
+        """forget() for ids that only went through filter_local()"""
+        with self._lock:
+            for message_id in message_ids:
+                self._seen.pop(message_id, None)
+
+
+class SharedMessageDeduplicator(MessageDeduplicator):
+    """Dedup across workers and nodes via the processed_messages table.
+
+    The local LRU still answers repeats seen by this process without a
+    round trip; everything else is settled by claim(), one INSERT ... ON
+    CONFLICT per call. If the database is unreachable, messages are let
+    through rather than dropped.
+    """
+
+    def __init__(self, max_entries, retention_hours, purge_probability=0.01):
+        super().__init__(max_entries)
+        self.retention_hours = retention_hours
+        self.purge_probability = purge_probability
+
+    def claim(self, message_ids):
+        candidates = list(message_ids)
+        if not candidates:
+            return candidates
+
+        try:
+            with get_db_connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("""
+                        INSERT INTO processed_messages (message_id)
+                        SELECT unnest(%s::text[])
+                        ON CONFLICT (message_id) DO NOTHING
+                        RETURNING message_id
+                    """, (candidates,))
+                    inserted = {row[0] for row in cursor.fetchall()}
+                    if random.random() < self.purge_probability:
+                        cursor.execute("""
+                            DELETE FROM processed_messages
+                            WHERE seen_at < NOW() - %s * INTERVAL '1 hour'
+                        """, (self.retention_hours,))
+        except DatabaseUnavailable:
+            return candidates
+        except Exception as e:
+            logger.error("Error checking processed messages: %s", e)
+            return candidates
+
+        self.duplicates += len(candidates) - len(inserted)
+        return [message_id for message_id in candidates if message_id in inserted]
+
+    def forget(self, message_ids):
+        super().forget(message_ids)
+        if not message_ids:
+            return
+        try:
+            with get_db_connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(
+                        "DELETE FROM processed_messages WHERE message_id = ANY(%s)",
+                        (list(message_ids),)
+                    )
+        except DatabaseUnavailable:
+            pass
+        except Exception as e:
+            logger.error("Error clearing processed messages: %s", e)
+
+
+def create_deduplicator():
+    """Build the deduplicator selected by DEDUP_BACKEND ("memory" or "postgres")"""
+    if Config.DEDUP_BACKEND == "postgres":
+        return SharedMessageDeduplicator(Config.DEDUP_MAX_ENTRIES, Config.DEDUP_RETENTION_HOURS)
+    return MessageDeduplicator(Config.DEDUP_MAX_ENTRIES)
@@ -1,17 +1,38 @@
+import logging
+import time
 import requests
-from config import WHATSAPP_CONFIG
+from config import Config
+from metrics import timed
 from database.models import log_message
+from database.outbox import queue_message
+from .outbound import get_dispatcher, GraphAPIError
+from .workers import current_pool, get_webhook_pool
+from .state import create_state_store
+from .session import Session
+from .reply import Reply, PayloadTemplate
 
-user_states = {}
+logger = logging.getLogger(__name__)
 
-def send_reply(sender, reply, buttons=None):
-    url = f"https://graph.facebook.com/v19.0/{WHATSAPP_CONFIG['phone_number_id']}/messages"
-    headers = {
-        "Authorization": f"Bearer {WHATSAPP_CONFIG['access_token']}",
-        "Content-Type": "application/json"
-    }
-    
-    if buttons and len(buttons) <= 3:
+state_store = create_state_store()
+
+def build_payload(sender, reply, buttons=None, sections=None):
+    if sections:
+        payload = {
+            "messaging_product": "whatsapp",
+            "to": sender,
+            "type": "interactive",
+            "interactive": {
+                "type": "list",
+                "body": {
+                    "text": reply
+                },
+                "action": {
+                    "button": "Choose",
+                    "sections": sections
+                }
+            }
+        }
+    elif buttons and len(buttons) <= 3:
         payload = {
             "messaging_product": "whatsapp",
             "to": sender,
@@ -33,35 +54,86 @@ def send_reply(sender, reply, buttons=None):
             "type": "text",
             "text": {"body": reply}
         }
-    
+    return payload
+
+def outbox_reply(sender, reply, buttons=None):
+    """The (payload, body) to queue alongside a state change, if the outbox is on"""
+    if Config.OUTBOX_ENABLED:
+        return build_payload(sender, reply, buttons), reply
+    return None
+
+def static_reply(text, buttons=None, sections=None):
+    """A Reply for a constant message, with its payload serialized once up front"""
+    return Reply(text, buttons, sections, PayloadTemplate(build_payload(None, text, buttons, sections)))
+
+def deliver(sender, reply, started=None):
+    """Send a handler's reply. The one place inbound messages get answered.
+
+    `reply` is a Reply, a plain string, or None/"" for nothing to send.
+    `started` is the perf_counter() reading when handling began; the
+    elapsed time is logged as the reply's processing_time_ms.
+    """
+    if not reply:
+        return False
+    if isinstance(reply, str):
+        reply = Reply(reply)
+    if reply.template is not None and not Config.OUTBOX_ENABLED:
+        return send_payload(sender, reply.template.render(sender), reply.text, started)
+    return send_reply(sender, reply.text, reply.buttons, reply.sections, started)
+
+def send_reply(sender, reply, buttons=None, sections=None, started=None):
+    payload = build_payload(sender, reply, buttons, sections)
+    if Config.OUTBOX_ENABLED:
+        # The outbox drainer sends it and logs the outcome
+        return queue_message(sender, payload, reply)
+    return send_payload(sender, payload, reply, started)
+
+def send_payload(sender, payload, reply, started=None):
+    """Send a built payload (dict or JSON bytes) now and log the outcome.
+
+    Rate-limit waits and retry backoff only happen on a worker thread. On
+    the webhook request itself (WEBHOOK_ASYNC off) a send that would have
+    to wait is handed to the webhook pool instead, so Meta isn't kept
+    waiting for the response.
+    """
+    inline = current_pool() is None
     try:
-        response = requests.post(url, headers=headers, json=payload)
-        response.raise_for_status()
-        print("✅ Reply sent successfully to", sender)
-        log_message(sender, "Outgoing", reply, success=True)
+        get_dispatcher().send(sender, payload, wait=not inline)
+        logger.debug("Reply sent", extra={"sender": sender})
+        log_message(sender, "Outgoing", reply, success=True, processing_time=_elapsed_ms(started))
         return True
     except requests.exceptions.RequestException as e:
-        print("❌ Error sending reply:", e)
-        log_message(sender, "Outgoing", f"Failed to send: {str(e)}", success=False)
+        retryable = isinstance(e, GraphAPIError) and e.retryable
+        if inline and retryable and get_webhook_pool().submit(send_payload, sender, payload, reply, started, key=sender):
+            logger.info("Reply deferred to the webhook pool: %s", e, extra={"sender": sender})
+            return True
+        logger.warning("Error sending reply: %s", e, extra={"sender": sender})
+        log_message(sender, "Outgoing", f"Failed to send: {str(e)}", success=False,
+                    processing_time=_elapsed_ms(started))
         return False
 
-def handle_menu():
-    return (
-        "Welcome to School Parent Portal! 🎒\n\n"
-        "1️⃣ Check Balance → Reply with: *1*\n"
-        "2️⃣ Report Lost Tag → Reply with: *2*\n"
-        "3️⃣ View Children → Reply with: *3*\n"
-        "4️⃣ Top-Up Instructions → Reply with: *4*\n"
-        "5️⃣ Change Phone Number → Reply with: *5*\n"
-        "6️⃣ Talk to Support → Reply with: *6*\n"
-        "🧑‍💼 We'll connect you to someone who can assist."
-    )
+def _elapsed_ms(started):
+    if started is None:
+        return None
+    return int((time.perf_counter() - started) * 1000)
 
+MENU_TEXT = (
+    "Welcome to School Parent Portal! 🎒\n\n"
+    "1️⃣ Check Balance → Reply with: *1*\n"
+    "2️⃣ Report Lost Tag → Reply with: *2*\n"
+    "3️⃣ View Children → Reply with: *3*\n"
+    "4️⃣ Top-Up Instructions → Reply with: *4*\n"
+    "5️⃣ Change Phone Number → Reply with: *5*\n"
+    "6️⃣ Talk to Support → Reply with: *6*\n"
+    "🧑‍💼 We'll connect you to someone who can assist."
+)
 
-def handle_balance_options():
-    menu_text = "💰 View your current account balance or someone else's.\n\nPlease select:"
-    
-    buttons = [
+# Menus never change, so their payloads are rendered once at import
+MAIN_MENU = static_reply(MENU_TEXT)
+
+BALANCE_OPTIONS = static_reply(
+    "💰 View your current account balance or someone else's.\n\nPlease select:",
+    [
         {
             "type": "reply",
             "reply": {
@@ -84,13 +156,11 @@ def handle_balance_options():
             }
         }
     ]
-    
-    return menu_text, buttons
+)
 
-def handle_tag_options():
-    menu_text = "😔 Sorry to hear the tag is missing.\n\nPlease choose how to proceed:"
-    
-    buttons = [
+TAG_OPTIONS = static_reply(
+    "😔 Sorry to hear the tag is missing.\n\nPlease choose how to proceed:",
+    [
         {
             "type": "reply",
             "reply": {
@@ -113,12 +183,32 @@ def handle_tag_options():
             }
         }
     ]
-    
-    return menu_text, buttons
-
-def reset_user_state(sender):
-    if sender in user_states:
-        del user_states[sender]
-    for key in list(user_states.keys()):
-        if key.startswith(f"{sender}_"):
-            del user_states[key]
\ No newline at end of file
+)
+
+def handle_menu():
+    return MENU_TEXT
+
+def handle_balance_options():
+    return BALANCE_OPTIONS
+
+def handle_tag_options():
+    return TAG_OPTIONS
+
+def load_session(sender):
+    """The sender's Session, read once at the start of handling a message"""
+    with timed("state"):
+        session = state_store.get(sender) or Session()
+    session.changed = False
+    return session
+
+def save_session(sender, session):
+    """Write the Session back once the message is handled, if it changed"""
+    if not session.changed:
+        return
+    with timed("state"):
+        if session.state is None:
+            # Back at the main menu; nothing left worth keeping
+            state_store.delete(sender)
+        else:
+            state_store.set(sender, session)
+    session.changed = False
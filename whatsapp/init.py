@@ -1,12 +1,15 @@
-from .handler import send_reply, handle_menu, handle_balance_options, handle_tag_options, user_states
+from .reply import Reply
+from .handler import deliver, send_reply, handle_menu, handle_balance_options, handle_tag_options, state_store
 from .message_processor import process_message, handle_button_response, generate_reply,handle_tag_report_flow
 
 __all__ = [
+    'Reply',
+    'deliver',
     'send_reply',
     'handle_menu',
     'handle_balance_options',
     'handle_tag_options',
-    'user_states',
+    'state_store',
     'process_message',
     'handle_button_response',
     'handle_tag_report_flow',
@@ -0,0 +1,220 @@
+import random
+import threading
+import time
+from collections import OrderedDict
+import requests
+from config import Config
+from metrics import timed
+from .client import get_graph_client
+
+# Graph API error codes that mean "slow down" or "try again", even when the
+# HTTP status is a 400
+RETRYABLE_ERROR_CODES = {
+    1,       # API unknown
+    2,       # API service (temporary)
+    4,       # application request limit reached
+    80007,   # WhatsApp Business Account rate limit
+    130429,  # Cloud API throughput reached
+    131000,  # something went wrong
+    131016,  # service unavailable
+    131048,  # spam rate limit
+    131056,  # business/consumer pair rate limit
+}
+
+
+class GraphAPIError(requests.exceptions.RequestException):
+    """A send that failed for good, after any retries"""
+
+    def __init__(self, message, status=None, code=None, retryable=False):
+        super().__init__(message)
+        self.status = status
+        self.code = code
+        self.retryable = retryable
+
+
+class TokenBucket:
+    """Thread-safe token bucket refilled at `rate` tokens per second.
+
+    A rate of 0 (or less) means unlimited: every acquire succeeds at once.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self):
+        """Take a token if one is available, otherwise return seconds until one is"""
+        if self.rate <= 0:
+            return 0
+        with self.lock:
+            self._refill(time.monotonic())
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return True
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+
+def classify_error(error):
+    """Turn a requests exception into a GraphAPIError with a retry verdict"""
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return GraphAPIError(str(error), retryable=True)
+
+    response = getattr(error, "response", None)
+    if response is None:
+        return GraphAPIError(str(error))
+
+    status = response.status_code
+    code = None
+    message = str(error)
+    try:
+        body = response.json()
+    except ValueError:
+        body = None
+    # Usually {"error": {"code": ..., "message": ...}}, but proxies and
+    # outages can return any JSON at all
+    details = body.get("error") if isinstance(body, dict) else None
+    if isinstance(details, dict):
+        code = details.get("code")
+        message = details.get("message") or message
+    elif isinstance(details, str) and details:
+        message = details
+
+    retryable = status == 429 or status >= 500 or code in RETRYABLE_ERROR_CODES
+    return GraphAPIError(message, status=status, code=code, retryable=retryable)
+
+
+def retry_after(error):
+    """Seconds asked for by a Retry-After header, if any"""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    value = response.headers.get("Retry-After")
+    try:
+        return float(value) if value else None
+    except ValueError:
+        return None
+
+
+class OutboundDispatcher:
+    """Rate-limited, retrying sender for Graph API messages.
+
+    A global token bucket keeps this process under the account's messaging
+    throughput, and a small per-recipient bucket paces bursts to one parent.
+    The limits are per process, so with several gunicorn workers divide the
+    tier's rate between them.
+
+    429s, 5xx responses, network errors and Graph API throttling codes are
+    retried with jittered exponential backoff (or the Retry-After delay when
+    given). Any other 4xx is permanent and fails on the first attempt.
+    Both the rate-limit waits and the backoff sleep the calling thread;
+    send(..., wait=False) skips them for callers that can't block.
+    """
+
+    def __init__(self, client, rate, burst, recipient_rate, recipient_burst,
+                 max_retries=4, backoff_base=0.5, backoff_max=30, acquire_timeout=10,
+                 max_recipients=10000):
+        self.client = client
+        self.bucket = TokenBucket(rate, burst)
+        self.recipient_rate = recipient_rate
+        self.recipient_burst = recipient_burst
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.acquire_timeout = acquire_timeout
+        self.max_recipients = max_recipients
+        self._recipients = OrderedDict()
+        self._recipients_lock = threading.Lock()
+
+    def _recipient_bucket(self, recipient):
+        with self._recipients_lock:
+            bucket = self._recipients.get(recipient)
+            if bucket is None:
+                bucket = TokenBucket(self.recipient_rate, self.recipient_burst)
+                self._recipients[recipient] = bucket
+                if len(self._recipients) > self.max_recipients:
+                    self._recipients.popitem(last=False)
+            else:
+                self._recipients.move_to_end(recipient)
+            return bucket
+
+    def _backoff(self, attempt):
+        # Full jitter: sleep anywhere between 0 and the exponential cap
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def send(self, recipient, payload, max_retries=None, wait=True):
+        """Send a payload, retrying transient failures. Raises GraphAPIError.
+
+        max_retries overrides the dispatcher's own setting for this call.
+        With wait=False nothing sleeps: a rate limit that isn't free right
+        now and any transient failure raise a retryable GraphAPIError at once.
+        """
+        if not wait:
+            max_retries = 0
+        elif max_retries is None:
+            max_retries = self.max_retries
+        with timed("send"):
+            return self._send(recipient, payload, max_retries, self.acquire_timeout if wait else 0)
+
+    def max_attempt_seconds(self):
+        """Roughly the longest one attempt can take: both rate-limit waits plus the HTTP timeouts"""
+        connect_timeout, read_timeout = getattr(self.client, "timeout", (0, 0))
+        return 2 * self.acquire_timeout + connect_timeout + read_timeout
+
+    def _send(self, recipient, payload, max_retries, acquire_timeout):
+        if not self._recipient_bucket(recipient).acquire(acquire_timeout):
+            raise GraphAPIError(f"Recipient {recipient} is being sent to too fast", retryable=True)
+
+        attempt = 0
+        while True:
+            if not self.bucket.acquire(acquire_timeout):
+                raise GraphAPIError("Outbound rate limit reached", retryable=True)
+            try:
+                return self.client.post_message(payload)
+            except requests.exceptions.RequestException as e:
+                error = classify_error(e)
+                if not error.retryable or attempt >= max_retries:
+                    raise error from e
+                delay = retry_after(e)
+                time.sleep(min(delay, self.backoff_max) if delay is not None else self._backoff(attempt))
+                attempt += 1
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_dispatcher():
+    """Return the process-wide outbound dispatcher"""
+    global _dispatcher
+    if _dispatcher is None:
+        with _dispatcher_lock:
+            if _dispatcher is None:
+                _dispatcher = OutboundDispatcher(
+                    get_graph_client(),
+                    rate=Config.OUTBOUND_RATE,
+                    burst=Config.OUTBOUND_BURST,
+                    recipient_rate=Config.OUTBOUND_RECIPIENT_RATE,
+                    recipient_burst=Config.OUTBOUND_RECIPIENT_BURST,
+                    max_retries=Config.OUTBOUND_MAX_RETRIES,
+                    backoff_base=Config.OUTBOUND_BACKOFF_BASE,
+                    backoff_max=Config.OUTBOUND_BACKOFF_MAX,
+                    acquire_timeout=Config.OUTBOUND_ACQUIRE_TIMEOUT,
+                )
+    return _dispatcher
@@ -0,0 +1,138 @@
+import atexit
+import logging
+import random
+import threading
+import time
+from config import Config
+from applog import configure_logging
+from database.models import log_messages
+from database.outbox import claim_outbox_batch, complete_outbox
+from .outbound import GraphAPIError, get_dispatcher
+
+logger = logging.getLogger(__name__)
+
+# Slack between the database starting a lease and this process seeing the batch
+LEASE_MARGIN_SECONDS = 5
+
+
+class OutboxDrainer:
+    """Background threads that claim queued replies and send them.
+
+    Each thread claims its own batch, so several threads, or several
+    processes and nodes, can drain the same outbox in parallel.
+
+    Every send is a single attempt; failures go back to the outbox with
+    a backoff, counted in `attempts`. A row is only sent while its lease
+    has room left for a worst-case attempt. Rows the batch doesn't reach
+    in time are released unsent, rather than risk another drainer
+    claiming a row whose send is still in flight and sending it twice.
+    """
+
+    def __init__(self, dispatcher, batch_size=20, threads=1, poll_interval=1.0,
+                 lease_seconds=60, max_attempts=10, retry_base=5, retry_max=600):
+        self.dispatcher = dispatcher
+        self.batch_size = batch_size
+        self.num_threads = threads
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self._stop = threading.Event()
+        self._threads = []
+        # Time after claiming by which the last send of a batch must start
+        self.send_window = lease_seconds - LEASE_MARGIN_SECONDS - dispatcher.max_attempt_seconds()
+        if self.send_window <= 0:
+            raise ValueError(
+                f"OUTBOX_LEASE_SECONDS={lease_seconds} is too short for one send "
+                f"(up to {dispatcher.max_attempt_seconds():.0f}s plus a {LEASE_MARGIN_SECONDS}s margin)"
+            )
+
+    def start(self):
+        if self._threads:
+            return
+        self._stop.clear()
+        for i in range(self.num_threads):
+            thread = threading.Thread(target=self._run, name=f"outbox-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def _retry_delay(self, attempts):
+        return random.uniform(0, min(self.retry_max, self.retry_base * (2 ** attempts)))
+
+    def drain_once(self):
+        """Claim and send one batch. Returns the number of messages claimed."""
+        rows = claim_outbox_batch(self.batch_size, self.lease_seconds)
+        if not rows:
+            return 0
+        deadline = time.monotonic() + self.send_window
+
+        sent_ids, retry_rows, failed_rows, released_ids, log_rows = [], [], [], [], []
+        for index, (outbox_id, recipient, payload, body, attempts) in enumerate(rows):
+            if time.monotonic() > deadline:
+                released_ids = [row[0] for row in rows[index:]]
+                break
+            try:
+                # Retries go through the outbox, not a sleep inside the lease
+                self.dispatcher.send(recipient, payload, max_retries=0)
+                sent_ids.append(outbox_id)
+                log_rows.append((recipient, "Outgoing", body, True, None, None))
+            except GraphAPIError as e:
+                if e.retryable and attempts < self.max_attempts:
+                    retry_rows.append((self._retry_delay(attempts), str(e), outbox_id))
+                else:
+                    failed_rows.append((str(e), outbox_id))
+                    log_rows.append((recipient, "Outgoing", f"Failed to send: {e}", False, str(e), None))
+
+        complete_outbox(sent_ids, retry_rows, failed_rows, released_ids)
+        log_messages(log_rows)
+        return len(rows)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                claimed = self.drain_once()
+            except Exception as e:
+                logger.exception("Error draining outbox: %s", e)
+                claimed = 0
+            if claimed < self.batch_size:
+                self._stop.wait(self.poll_interval)
+
+
+_drainer = None
+_drainer_lock = threading.Lock()
+
+
+def start_outbox_drainer():
+    """Start the process-wide outbox drainer"""
+    global _drainer
+    with _drainer_lock:
+        if _drainer is None:
+            _drainer = OutboxDrainer(
+                get_dispatcher(),
+                batch_size=Config.OUTBOX_BATCH_SIZE,
+                threads=Config.OUTBOX_DRAIN_THREADS,
+                poll_interval=Config.OUTBOX_POLL_INTERVAL,
+                lease_seconds=Config.OUTBOX_LEASE_SECONDS,
+                max_attempts=Config.OUTBOX_MAX_ATTEMPTS,
+            )
+            atexit.register(_drainer.stop, Config.OUTBOX_POLL_INTERVAL + 5)
+        _drainer.start()
+    return _drainer
+
+
+if __name__ == "__main__":
+    # Run as a dedicated sender: python -m whatsapp.outbox
+    configure_logging()
+    drainer = start_outbox_drainer()
+    try:
+        while True:
+            threading.Event().wait(3600)
+    except KeyboardInterrupt:
+        drainer.stop()
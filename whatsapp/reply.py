@@ -0,0 +1,35 @@
+from typing import NamedTuple, Optional
+from jsoncodec import dumps
+
+
+class PayloadTemplate:
+    """A message payload serialized once, with only the recipient filled in per send.
+
+    The "to" field is moved to the front so a send is two byte concatenations
+    instead of building the dict and encoding it to JSON again.
+    """
+
+    __slots__ = ("suffix",)
+
+    def __init__(self, payload):
+        rest = {key: value for key, value in payload.items() if key != "to"}
+        encoded = dumps(rest)
+        self.suffix = b"," + encoded[1:] if rest else b"}"
+
+    def render(self, recipient):
+        return b'{"to":' + dumps(recipient) + self.suffix
+
+
+class Reply(NamedTuple):
+    """What a handler wants sent back to the parent.
+
+    Handlers return one of these (or a plain string, or None when there is
+    nothing to send, e.g. a reply already queued in the outbox) and
+    handler.deliver() sends it. `buttons` are WhatsApp reply buttons (up to
+    three); `sections` turns the message into a list message instead.
+    Constant replies carry a pre-rendered `template` (see handler.static_reply).
+    """
+    text: str
+    buttons: Optional[list] = None
+    sections: Optional[list] = None
+    template: Optional[PayloadTemplate] = None
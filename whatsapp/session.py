@@ -0,0 +1,94 @@
+import sys
+from enum import Enum
+from typing import NamedTuple
+
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class ConversationState(str, Enum):
+    AWAITING_BALANCE_PHONE = "awaiting_balance_phone"
+    AWAITING_BALANCE_ID = "awaiting_balance_id"
+    AWAITING_PHONE_CHANGE_TYPE = "awaiting_phone_change_type"
+    AWAITING_PHONE_VERIFICATION = "awaiting_phone_verification"
+    AWAITING_NEW_NUMBER = "awaiting_new_number"
+    AWAITING_CHILD_SELECTION = "awaiting_child_selection"
+    AWAITING_TAG_ACTION = "awaiting_tag_action"
+
+
+class ChildTag(NamedTuple):
+    """The parts of a child row the tag-report flow actually uses"""
+    child_id: int
+    full_name: str
+    school_name: str
+    grade: str
+    tag_id: int
+
+    @classmethod
+    def from_row(cls, row):
+        """Build from a fetch_children_by_parent_phone(include_tags=True) row"""
+        child_id, full_name, gender, school_name, grade, tag_id, tag_status = row
+        # School and grade names repeat across thousands of sessions; share one copy
+        return cls(child_id, full_name, _intern(school_name), _intern(grade), tag_id)
+
+
+class Session:
+    """One sender's in-flight conversation.
+
+    Replaces the f"{sender}_children"-style keys in one shared dict: a
+    reset is a single delete, and __slots__ keeps each instance to a fixed
+    handful of pointers. bench/session_memory.py measures the difference.
+
+    A message's handlers change the Session through update() and reset(),
+    which mark it `changed`, so it is loaded once per message and only
+    written back when something actually changed.
+    """
+
+    FIELDS = ("state", "children", "selected_child", "balance_phone", "old_phone", "national_id")
+    __slots__ = FIELDS + ("changed",)
+
+    def __init__(self, state=None, children=(), selected_child=None,
+                 balance_phone=None, old_phone=None, national_id=None):
+        self.state = state
+        self.children = children
+        self.selected_child = selected_child
+        self.balance_phone = balance_phone
+        self.old_phone = old_phone
+        self.national_id = national_id
+        self.changed = False
+
+    def update(self, **fields):
+        for name, value in fields.items():
+            setattr(self, name, value)
+        self.changed = True
+
+    def reset(self):
+        """Back to the main menu with nothing remembered"""
+        if any(getattr(self, name) for name in self.FIELDS):
+            self.__init__()
+            self.changed = True
+
+    def to_dict(self):
+        """JSON-serialisable form, for shared state stores"""
+        return {
+            "state": self.state.value if self.state else None,
+            "children": [list(child) for child in self.children],
+            "selected_child": list(self.selected_child) if self.selected_child else None,
+            "balance_phone": self.balance_phone,
+            "old_phone": self.old_phone,
+            "national_id": self.national_id,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        state = data.get("state")
+        selected_child = data.get("selected_child")
+        return cls(
+            state=ConversationState(state) if state else None,
+            children=tuple(ChildTag(*child) for child in data.get("children") or ()),
+            selected_child=ChildTag(*selected_child) if selected_child else None,
+            balance_phone=data.get("balance_phone"),
+            old_phone=data.get("old_phone"),
+            national_id=data.get("national_id"),
+        )
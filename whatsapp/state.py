@@ -0,0 +1,131 @@
+import abc
+import logging
+import random
+import threading
+import time
+from collections import OrderedDict
+from psycopg.types.json import Jsonb
+from config import Config
+from database.pool import get_db_connection, DatabaseUnavailable
+from .session import Session
+
+logger = logging.getLogger(__name__)
+
+
+class StateStore(abc.ABC):
+    """Where each sender's conversation Session lives between messages.
+
+    Sessions expire `ttl` seconds after they were last saved.
+    """
+
+    @abc.abstractmethod
+    def get(self, sender):
+        """The sender's Session, or None if there is none or it expired"""
+
+    @abc.abstractmethod
+    def set(self, sender, session):
+        """Save the sender's Session, restarting its expiry clock"""
+
+    @abc.abstractmethod
+    def delete(self, sender):
+        """Forget the sender's Session"""
+
+
+class MemoryStateStore(StateStore):
+    """Per-process store bounded by size (LRU) and age (TTL)"""
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, sender):
+        with self._lock:
+            item = self._sessions.get(sender)
+            if item is None:
+                return None
+            expires_at, session = item
+            if expires_at < time.monotonic():
+                del self._sessions[sender]
+                return None
+            self._sessions.move_to_end(sender)
+            return session
+
+    def set(self, sender, session):
+        with self._lock:
+            self._sessions[sender] = (time.monotonic() + self.ttl, session)
+            self._sessions.move_to_end(sender)
+            while len(self._sessions) > self.max_entries:
+                self._sessions.popitem(last=False)
+
+    def delete(self, sender):
+        with self._lock:
+            self._sessions.pop(sender, None)
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+class PostgresStateStore(StateStore):
+    """Store shared by every worker and node, in an UNLOGGED table.
+
+    UNLOGGED skips the WAL, so writes are cheap; the trade-off is that
+    in-flight conversations are lost if Postgres crashes, which only means
+    those parents start again from the menu. Expired rows are ignored on
+    read and purged now and then on write.
+    """
+
+    def __init__(self, ttl, purge_probability=0.01):
+        self.ttl = ttl
+        self.purge_probability = purge_probability
+
+    def get(self, sender):
+        try:
+            with get_db_connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("""
+                        SELECT data FROM conversation_state
+                        WHERE sender = %s AND expires_at > NOW()
+                    """, (sender,))
+                    row = cursor.fetchone()
+                    return Session.from_dict(row[0]) if row else None
+        except DatabaseUnavailable:
+            return None
+        except Exception as e:
+            logger.error("Error loading conversation state: %s", e)
+            return None
+
+    def set(self, sender, session):
+        try:
+            with get_db_connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("""
+                        INSERT INTO conversation_state (sender, data, expires_at)
+                        VALUES (%s, %s, NOW() + %s * INTERVAL '1 second')
+                        ON CONFLICT (sender) DO UPDATE
+                        SET data = EXCLUDED.data, expires_at = EXCLUDED.expires_at
+                    """, (sender, Jsonb(session.to_dict()), self.ttl))
+                    if random.random() < self.purge_probability:
+                        cursor.execute("DELETE FROM conversation_state WHERE expires_at < NOW()")
+        except DatabaseUnavailable:
+            pass
+        except Exception as e:
+            logger.error("Error saving conversation state: %s", e)
+
+    def delete(self, sender):
+        try:
+            with get_db_connection() as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute("DELETE FROM conversation_state WHERE sender = %s", (sender,))
+        except DatabaseUnavailable:
+            pass
+        except Exception as e:
+            logger.error("Error clearing conversation state: %s", e)
+
+
+def create_state_store():
+    """Build the store selected by STATE_BACKEND ("memory" or "postgres")"""
+    if Config.STATE_BACKEND == "postgres":
+        return PostgresStateStore(Config.STATE_TTL)
+    return MemoryStateStore(Config.STATE_TTL, Config.STATE_MAX_ENTRIES)
@@ -0,0 +1,93 @@
+from collections import deque
+
+
+class StateMachine:
+    """Declarative (state, input) → handler table for a conversation.
+
+    Handlers are registered once, at import time:
+
+    - `on(state, *inputs)` for exact (lower-cased) inputs in one state
+    - `anywhere(*inputs)` for commands that work in every state
+    - `otherwise(state)` for free-form input, e.g. a phone number
+
+    Dispatch is then two dict lookups, however many states there are.
+    Each registration lists the states its handler can move to in
+    `targets`, which lets `validate()` check that every state can be
+    reached from the initial one and has a handler for unexpected input.
+    """
+
+    def __init__(self, states, initial=None):
+        self.states = tuple(states)
+        self.initial = initial
+        self._routes = {}
+        self._global = {}
+        self._fallbacks = {}
+        self._edges = {}
+        self._global_targets = set()
+
+    def _add_edges(self, state, targets):
+        self._edges.setdefault(state, set()).update(targets)
+
+    def on(self, state, *inputs, targets=()):
+        def register(handler):
+            for text in inputs:
+                if (state, text) in self._routes:
+                    raise ValueError(f"Duplicate transition for {state!r} on {text!r}")
+                self._routes[(state, text)] = handler
+            self._add_edges(state, targets)
+            return handler
+        return register
+
+    def anywhere(self, *inputs, targets=()):
+        def register(handler):
+            for text in inputs:
+                if text in self._global:
+                    raise ValueError(f"Duplicate global command {text!r}")
+                self._global[text] = handler
+            self._global_targets.update(targets)
+            return handler
+        return register
+
+    def otherwise(self, state, targets=()):
+        def register(handler):
+            if state in self._fallbacks:
+                raise ValueError(f"Duplicate fallback for {state!r}")
+            self._fallbacks[state] = handler
+            self._add_edges(state, targets)
+            return handler
+        return register
+
+    def resolve(self, state, text):
+        """Return the handler for `text` (already lower-cased) in `state`"""
+        handler = self._global.get(text)
+        if handler is None:
+            handler = self._routes.get((state, text))
+            if handler is None:
+                handler = self._fallbacks.get(state)
+        return handler
+
+    def dispatch(self, state, text, *context):
+        """Run the matching handler as handler(*context, text), with the text stripped"""
+        text = text.strip()
+        handler = self.resolve(state, text.lower())
+        return handler(*context, text) if handler is not None else None
+
+    def validate(self):
+        """Raise ValueError if a state is unreachable or can't handle stray input"""
+        seen = {self.initial}
+        queue = deque([self.initial])
+        while queue:
+            state = queue.popleft()
+            for target in self._edges.get(state, set()) | self._global_targets:
+                if target not in seen:
+                    seen.add(target)
+                    queue.append(target)
+
+        problems = []
+        for state in (self.initial,) + self.states:
+            if state not in seen:
+                problems.append(f"{state!r} is unreachable")
+            if state not in self._fallbacks:
+                problems.append(f"{state!r} has no fallback handler")
+        if problems:
+            raise ValueError("Invalid state machine: " + "; ".join(problems))
@@ -0,0 +1,204 @@
+import atexit
+import heapq
+import logging
+import threading
+import time
+from collections import deque
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# Which pool, if any, the current thread is a worker of
+_local = threading.local()
+
+
+def current_pool():
+    """The WorkerPool running the current thread, or None off the pools (e.g. a request thread)"""
+    return getattr(_local, "pool", None)
+
+
+class WorkerPool:
+    """Bounded in-process pool of threads that run queued jobs.
+
+    Jobs submitted with the same key run one at a time in FIFO order;
+    jobs for different keys run in parallel. Each key with work waiting
+    sits in a ready queue, and any free worker takes the next key from it,
+    runs that key's oldest job, then puts the key back at the end of the
+    ready queue if it has more. A slow job or a long backlog therefore
+    only holds up its own key, and keys take turns rather than one busy
+    key starving the rest. Jobs without a key run on any free worker.
+
+    submit() never blocks: when the pool holds `queue_size` jobs it
+    returns False so the caller can shed load instead of stalling.
+
+    stats() lists the keys with the oldest waiting work, so one slow
+    sender holding up its own queue shows up by name.
+    """
+
+    def __init__(self, num_workers, queue_size, name="worker"):
+        self.num_workers = num_workers
+        self.queue_size = queue_size
+        self.name = name
+        # key -> deque of (enqueued_at, fn, args); a key is present while
+        # it has jobs waiting or one running, and in _ready only in the former case
+        self._queues = {}
+        self._ready = deque()
+        # key -> when its current job started, while one is running
+        self._running = {}
+        self._size = 0
+        self._cond = threading.Condition()
+        self._threads = []
+        self._accepting = True
+        self._stopping = False
+        self.busy = 0
+        self.processed = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    def start(self):
+        with self._cond:
+            if self._threads:
+                return
+            self._stopping = False
+            for i in range(self.num_workers):
+                thread = threading.Thread(target=self._run, name=f"{self.name}-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, fn, *args, key=None):
+        """Queue fn(*args) behind earlier jobs for key. Returns False if full or shutting down."""
+        if not self._accepting:
+            return False
+        if not self._threads:
+            self.start()
+        if key is None:
+            # Its own key, so it can run alongside anything
+            key = object()
+        with self._cond:
+            if self._size >= self.queue_size:
+                return False
+            jobs = self._queues.get(key)
+            if jobs is None:
+                jobs = self._queues[key] = deque()
+                self._ready.append(key)
+                self._cond.notify()
+            jobs.append((time.monotonic(), fn, args))
+            self._size += 1
+        return True
+
+    def qsize(self):
+        return self._size
+
+    def stats(self, top_keys=5):
+        with self._cond:
+            depth = self._size
+            oldest = min((jobs[0][0] for jobs in self._queues.values() if jobs), default=None)
+            keys = len(self._queues)
+            busy = self.busy
+            backlog = heapq.nsmallest(
+                top_keys,
+                ((jobs[0][0], key, len(jobs), self._running.get(key)) for key, jobs in self._queues.items() if jobs),
+                key=lambda item: item[0],
+            )
+        now = time.monotonic()
+        return {
+            "workers": self.num_workers,
+            "busy": busy,
+            "queue_depth": depth,
+            "keys": keys,
+            "oldest_age_ms": round((time.monotonic() - oldest) * 1000, 1) if oldest else 0,
+            "last_lag_ms": round(self.last_lag * 1000, 1),
+            "max_lag_ms": round(self.max_lag * 1000, 1),
+            "processed": self.processed,
+            # Keyless jobs have a private key object; they're listed without a name
+            "backlog": [
+                {
+                    "key": key if isinstance(key, str) else None,
+                    "depth": key_depth,
+                    "oldest_age_ms": round((now - enqueued_at) * 1000, 1),
+                    "running_ms": round((now - started) * 1000, 1) if started is not None else None,
+                }
+                for enqueued_at, key, key_depth, started in backlog
+            ],
+        }
+
+    def _next_job(self):
+        with self._cond:
+            while not self._ready:
+                if self._stopping:
+                    return None, None
+                self._cond.wait()
+            key = self._ready.popleft()
+            enqueued_at, fn, args = self._queues[key].popleft()
+            self._size -= 1
+            self.busy += 1
+            started = self._running[key] = time.monotonic()
+        lag = started - enqueued_at
+        self.last_lag = lag
+        if lag > self.max_lag:
+            self.max_lag = lag
+        return key, (fn, args)
+
+    def _finish(self, key):
+        with self._cond:
+            self.busy -= 1
+            self.processed += 1
+            del self._running[key]
+            if self._queues[key]:
+                self._ready.append(key)
+                self._cond.notify()
+            else:
+                del self._queues[key]
+
+    def _run(self):
+        _local.pool = self
+        while True:
+            key, job = self._next_job()
+            if job is None:
+                return
+            fn, args = job
+            try:
+                fn(*args)
+            except Exception as e:
+                logger.exception("Error in %s job: %s", self.name, e)
+            finally:
+                self._finish(key)
+
+    def shutdown(self, timeout=None):
+        """Stop accepting jobs, let workers drain the queue, then stop them"""
+        self._accepting = False
+        with self._cond:
+            threads = list(self._threads)
+            self._threads = []
+            # Workers only exit once nothing is left to run
+            self._stopping = True
+            self._cond.notify_all()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in threads:
+            thread.join(None if deadline is None else max(0, deadline - time.monotonic()))
+
+
+_webhook_pool = None
+_webhook_pool_lock = threading.Lock()
+
+
+def get_webhook_pool():
+    """Return the webhook worker pool, created lazily in each worker process"""
+    global _webhook_pool
+    if _webhook_pool is None:
+        with _webhook_pool_lock:
+            if _webhook_pool is None:
+                _webhook_pool = WorkerPool(
+                    Config.WEBHOOK_WORKERS,
+                    Config.WEBHOOK_QUEUE_SIZE,
+                    name="webhook",
+                )
+                atexit.register(_webhook_pool.shutdown, Config.WEBHOOK_DRAIN_TIMEOUT)
+    return _webhook_pool
+
+
+def get_webhook_pool_stats():
+    """Get queue depth, lag and busy workers for the webhook pool"""
+    if _webhook_pool is None:
+        return {}
+    return _webhook_pool.stats()